@@ -3,10 +3,12 @@ import re
 import json
 import traceback
 
-from llm_api import GPT, parse_json, llm_request
+from llm_api import GPT, parse_json, llm_request, llm_request_stream, routed_llm_request, usage_context, consume_retry, get_llm_parallelism, LLMCancelled, RetryBudgetExhausted
 from langchain.document_loaders.text import TextLoader
 from langchain.text_splitter import LatexTextSplitter
-from util import multiprocess, get_cpu_count
+from util import multiprocess, multiprocess_as_completed
+from structure_extraction import compact_structure
+from token_counter import count_tokens
 
 
 def replace_at_sentences(text):
@@ -117,26 +119,42 @@ Please only provide suggestions for improvement, not the results of the improvem
 def section_analysis(section_label, section_content, section_structure, overall_structure):
     if len(section_content) < 100:
         return section_content
-    request = content_analysis_prompt.format(section_label=section_label, paper_structure=overall_structure, section_structure=section_structure,
+    request = content_analysis_prompt.format(section_label=section_label, paper_structure=compact_structure(overall_structure),
+                                             section_structure=compact_structure(section_structure),
                                              section_content=section_content,
                                              content_analysis_example=content_analysis_example)
     max_try = 3
     try_count = 0
     while try_count < max_try:
         try:
-            reply = llm_request(request)
-            reply = replace_at_sentences(reply)
+            if try_count > 0:
+                consume_retry()
+            with usage_context(stage="section_analysis"):
+                reply = routed_llm_request(request, "section_analysis", validate_func=validate_section_analysis, input_text=section_content,
+                                           refresh_cache=try_count > 0)
             return reply
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, LLMCancelled):
             return
+        except RetryBudgetExhausted:
+            raise
         except:
             traceback.print_exc()
             try_count += 1
 
 
-def section_analysis_async(dt_section, dt_section_structure, overall_structure):
-    print("Analysis section asynchronously")
+def validate_section_analysis(reply):
+    """
+    检查分析结果是否包含要求的两个部分，不满足时抛出异常（由路由升级到更大的模型）
+    """
+    if "Section Content with Annotations" not in reply or "Logical Flow Commentary" not in reply:
+        raise ValueError("section analysis reply is missing required parts")
+    return replace_at_sentences(reply)
+
 
+def iter_section_analysis(dt_section, dt_section_structure, overall_structure):
+    """
+    并行分析所有section（长的先开始），每完成一个yield (section_label, 分析结果)
+    """
     def fun(section_pair, overall_structure):
         section_label, section_content, section_structure = section_pair
         return section_analysis(section_label, section_content, section_structure, overall_structure)
@@ -144,28 +162,63 @@ def section_analysis_async(dt_section, dt_section_structure, overall_structure):
     ls_section_pair = []
     for section_label in dt_section.keys():
         ls_section_pair.append((section_label, dt_section[section_label], dt_section_structure[section_label]))
-    ls_analysis_result = multiprocess(
+    for i, analysis_result in multiprocess_as_completed(
         func=fun,
         paras=ls_section_pair,
         overall_structure=overall_structure,
-        n_processes=min(len(ls_section_pair), get_cpu_count())
-    )
-    return ls_analysis_result
-
-
-def modify_scheme_design(user_instruction, section_label, section_content, section_structure, overall_structure):
-    request = modify_scheme_design_prompt.format(user_instruction=user_instruction, section_label=section_label, overall_structure=overall_structure,
-                                                 section_structure=section_structure,
+        n_processes=get_llm_parallelism(len(ls_section_pair)),
+        cost_func=lambda section_pair: count_tokens(section_pair[1])
+    ):
+        yield ls_section_pair[i][0], analysis_result
+
+
+def section_analysis_async(dt_section, dt_section_structure, overall_structure, progress_callback=None, dt_analysis_result=None):
+    """
+    并行分析所有section，结果按dt_section的顺序返回
+    dt_analysis_result为之前已有的分析结果（如重新上传的论文中未修改的section），直接沿用，不再重新分析
+    每完成一个section调用progress_callback(section_label, 分析结果, 完成数量, 总数量)
+    """
+    print("Analysis section asynchronously")
+    dt_reused = {
+        section_label: analysis_result for section_label, analysis_result in (dt_analysis_result or {}).items()
+        if section_label in dt_section and analysis_result is not None
+    }
+    dt_analysis_result = {}
+    for section_label, analysis_result in dt_reused.items():
+        dt_analysis_result[section_label] = analysis_result
+        if progress_callback is not None:
+            progress_callback(section_label, analysis_result, len(dt_analysis_result), len(dt_section))
+    dt_changed = {section_label: section_content for section_label, section_content in dt_section.items() if section_label not in dt_reused}
+    for section_label, analysis_result in iter_section_analysis(dt_changed, dt_section_structure, overall_structure):
+        dt_analysis_result[section_label] = analysis_result
+        if progress_callback is not None:
+            progress_callback(section_label, analysis_result, len(dt_analysis_result), len(dt_section))
+    return [dt_analysis_result[section_label] for section_label in dt_section]
+
+
+def modify_scheme_design(user_instruction, section_label, section_content, section_structure, overall_structure, stream=False):
+    request = modify_scheme_design_prompt.format(user_instruction=user_instruction, section_label=section_label,
+                                                 overall_structure=compact_structure(overall_structure),
+                                                 section_structure=compact_structure(section_structure),
                                                  section_content=section_content)
+    if stream:
+        # 流式输出时返回增量文本的生成器，由调用方对累积文本做replace_at_sentences
+        with usage_context(stage="modify_scheme_design"):
+            return llm_request_stream(request)
     max_try = 3
     try_count = 0
     while try_count < max_try:
         try:
-            reply = llm_request(request)
+            if try_count > 0:
+                consume_retry()
+            with usage_context(stage="modify_scheme_design"):
+                reply = llm_request(request, refresh_cache=try_count > 0)
             reply = replace_at_sentences(reply)
             return reply
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, LLMCancelled):
             return
+        except RetryBudgetExhausted:
+            raise
         except:
             traceback.print_exc()
             try_count += 1
@@ -0,0 +1,143 @@
+from token_counter import count_tokens, tokens_per_message, tokens_per_reply
+
+
+class DropOldestStrategy:
+    """
+    超出预算时从最早的一轮对话开始丢弃
+    """
+
+    async def prune(self, memory, budget):
+        while memory.tokens_num > budget and memory.turns_num > 0:
+            memory.pop_oldest_turn()
+        return
+
+
+class SummarizeStrategy:
+    """
+    超出预算时将较早的对话压缩成一条摘要，保留最近keep_recent_turns轮原文
+    summarize_func(previous_summary, messages)为异步函数，返回新的摘要文本（包含previous_summary中的信息）
+    摘要后仍超出预算时，再丢弃最早的对话
+    """
+
+    def __init__(self, summarize_func, keep_recent_turns=2):
+        self.summarize_func = summarize_func
+        self.keep_recent_turns = keep_recent_turns
+
+    async def prune(self, memory, budget):
+        if memory.tokens_num <= budget:
+            return
+        ls_message = []
+        while memory.turns_num > self.keep_recent_turns:
+            ls_message += memory.pop_oldest_turn()
+        if ls_message:
+            summary = await self.summarize_func(memory.summary, ls_message)
+            if summary:
+                memory.set_summary(summary)
+        await DropOldestStrategy().prune(memory, budget)
+        return
+
+
+class ConversationMemory:
+    """
+    带token预算的对话历史：第一条system消息固定保留，其后是可选的摘要消息和按轮（user + assistant）组织的对话
+    每条消息的token数在加入时统计一次，总数增量维护
+    """
+
+    def __init__(self, system_content, max_tokens=None, strategy=None, llm_model="gpt-4"):
+        # max_tokens为None时不限制对话历史长度
+        self.max_tokens = max_tokens
+        self.strategy = strategy if strategy is not None else DropOldestStrategy()
+        self.llm_model = llm_model
+        self.reset([{"role": "system", "content": system_content}])
+
+    def reset(self, messages):
+        """
+        用messages重置对话历史，messages的第一条为system消息
+        """
+        self.summary = None
+        self._messages = []
+        self._counts = []
+        self._tokens_sum = 0
+        # 每轮对话在_messages中的起始下标
+        self._turn_starts = []
+        for message in messages:
+            self.append(message)
+        return
+
+    @property
+    def messages(self):
+        return self._messages
+
+    @property
+    def tokens_num(self):
+        return self._tokens_sum + tokens_per_message * len(self._messages) + tokens_per_reply
+
+    @property
+    def turns_num(self):
+        return len(self._turn_starts)
+
+    def _insert(self, index, message):
+        num_tokens = count_tokens(message["content"], self.llm_model)
+        self._messages.insert(index, message)
+        self._counts.insert(index, num_tokens)
+        self._tokens_sum += num_tokens
+        return
+
+    def append(self, message):
+        """
+        追加一条消息，user消息开始新的一轮对话
+        """
+        if message["role"] == "user" and self._messages:
+            self._turn_starts.append(len(self._messages))
+        self._insert(len(self._messages), message)
+        return
+
+    def pop_oldest_turn(self):
+        """
+        移除并返回最早的一轮对话
+        """
+        start = self._turn_starts.pop(0)
+        end = self._turn_starts[0] if self._turn_starts else len(self._messages)
+        ls_message = self._messages[start:end]
+        self._tokens_sum -= sum(self._counts[start:end])
+        del self._messages[start:end]
+        del self._counts[start:end]
+        self._turn_starts = [i - (end - start) for i in self._turn_starts]
+        return ls_message
+
+    def set_summary(self, summary):
+        """
+        设置（或替换）紧跟在system消息后的摘要消息
+        """
+        message = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+        if self.summary is not None:
+            self._tokens_sum -= self._counts.pop(1)
+            self._messages.pop(1)
+            self._turn_starts = [i - 1 for i in self._turn_starts]
+        self.summary = summary
+        self._insert(1, message)
+        self._turn_starts = [i + 1 for i in self._turn_starts]
+        return
+
+    def replace_content(self, old_content, new_content):
+        """
+        将所有包含old_content的消息内容替换为new_content，并更新被修改消息的token数
+        """
+        for i, item in enumerate(self._messages):
+            if old_content in item["content"]:
+                item["content"] = item["content"].replace(old_content, new_content)
+                num_tokens = count_tokens(item["content"], self.llm_model)
+                self._tokens_sum += num_tokens - self._counts[i]
+                self._counts[i] = num_tokens
+        return
+
+    async def prune(self, reserve_tokens=0):
+        """
+        为即将发送的reserve_tokens个token留出空间，超出预算时按strategy裁剪对话历史
+        """
+        if self.max_tokens is None:
+            return
+        budget = self.max_tokens - reserve_tokens
+        if self.tokens_num > budget:
+            await self.strategy.prune(self, budget)
+        return
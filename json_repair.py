@@ -0,0 +1,192 @@
+import json
+import multiprocessing
+import re
+
+# 解析结果计数：clean为直接可解析，repaired为本地修复成功，failed为无法修复（需要重新请求）
+# 以及各类修复被用到的次数；计数保存在共享内存中，util.multiprocess fork出的子进程计入同一份统计
+_outcomes = ["clean", "repaired", "failed"]
+_fixes = ["prose", "quotes", "literals", "trailing_comma", "truncated"]
+_counters = {name: multiprocessing.Value("i", 0) for name in _outcomes + _fixes}
+
+_closers = {"{": "}", "[": "]"}
+_literals = {"True": "true", "False": "false", "None": "null"}
+
+
+def _count(name):
+    counter = _counters[name]
+    with counter.get_lock():
+        counter.value += 1
+    return
+
+
+def _string_ends(text, i):
+    """
+    判断text[i]处的引号是否为字符串的结束：其后（跳过空白）是, : } ]或文本结尾
+    用于处理字符串内部未转义的引号和单引号字符串中的撇号
+    """
+    j = i + 1
+    while j < len(text) and text[j] in " \t\r\n":
+        j += 1
+    return j == len(text) or text[j] in ",:}]"
+
+
+def _extract_json_text(text):
+    """
+    去掉JSON前后的说明文字和代码块标记，返回从第一个{或[开始的文本
+    """
+    match = re.search(r"```(?:json)?[ \t]*\n([\s\S]*?)(?:```|$)", text)
+    if match:
+        text = match.group(1)
+    ls_start = [i for i in [text.find("{"), text.find("[")] if i >= 0]
+    if not ls_start:
+        return None
+    return text[min(ls_start):]
+
+
+def _scan(text, fixes):
+    """
+    逐字符扫描并修复：单引号字符串改为双引号，字符串内未转义的双引号加转义，Python字面量改为JSON字面量，删除尾随逗号
+    文本被截断时，优先截到最后一个完整的元素再补全括号，返回候选修复结果的列表
+    """
+    out = []
+    stack = []
+    # 未闭合括号在输出中的位置
+    ls_open = []
+    # 可以安全截断的位置：(输出长度, 当时未闭合的括号)，位于逗号之前或括号闭合之后
+    ls_cut = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char in "\"'":
+            if char == "'":
+                fixes.add("quotes")
+            out.append('"')
+            i += 1
+            closed = False
+            while i < len(text):
+                char_i = text[i]
+                if char_i == "\\" and i + 1 < len(text):
+                    # 单引号字符串中的\'不需要转义
+                    out.append(text[i + 1] if text[i + 1] == "'" else text[i : i + 2])
+                    i += 2
+                    continue
+                if char_i == char and _string_ends(text, i):
+                    closed = True
+                    i += 1
+                    break
+                if char_i == '"':
+                    fixes.add("quotes")
+                    out.append('\\"')
+                elif char_i == "\n":
+                    out.append("\\n")
+                else:
+                    out.append(char_i)
+                i += 1
+            out.append('"')
+            if not closed:
+                break
+            continue
+        if char in "{[":
+            stack.append(char)
+            ls_open.append(len(out))
+            out.append(char)
+        elif char in "}]":
+            # 删除闭合括号前的尾随逗号
+            while out and out[-1] in " \t\r\n":
+                out.pop()
+            if out and out[-1] == ",":
+                fixes.add("trailing_comma")
+                out.pop()
+            if stack:
+                stack.pop()
+                ls_open.pop()
+            out.append(char)
+            ls_cut.append((len(out), list(stack)))
+            if not stack:
+                return [("".join(out), stack)]
+        elif char == ",":
+            ls_cut.append((len(out), list(stack)))
+            out.append(char)
+        elif char.isalpha():
+            match = re.match(r"[A-Za-z]+", text[i:])
+            word = match.group(0)
+            if word in _literals:
+                fixes.add("literals")
+                word = _literals[word]
+            out.append(word)
+            i += len(match.group(0))
+            continue
+        else:
+            out.append(char)
+        i += 1
+
+    # 文本被截断：列表中未完成的对象整个丢弃，否则截到最后一个完整元素，最后尝试直接补全
+    fixes.add("truncated")
+    ls_candidate = []
+    if len(stack) >= 2 and stack[-2:] == ["[", "{"]:
+        ls_candidate.append(("".join(out[: ls_open[-1]]).rstrip().rstrip(","), stack[:-1]))
+    if ls_cut:
+        cut, cut_stack = ls_cut[-1]
+        ls_candidate.append(("".join(out[:cut]), cut_stack))
+    ls_candidate.append(("".join(out).rstrip().rstrip(",:"), stack))
+    return ls_candidate
+
+
+def _close(text, stack):
+    return text + "".join([_closers[char] for char in reversed(stack)])
+
+
+def repair_json(text, allow_truncated=True):
+    """
+    解析大模型回复中的JSON，无法直接解析时在本地修复常见问题：
+    前后的说明文字、单引号、Python字面量、尾随逗号、截断导致的括号缺失
+    allow_truncated=False时截断的回复视为修复失败（补全括号会丢掉未完成的元素，如结构中的节点），由调用方重新请求
+    修复失败时抛出ValueError，各类结果和修复的次数见repair_stats
+    """
+    try:
+        obj = json.loads(text)
+        _count("clean")
+        return obj
+    except (TypeError, ValueError):
+        pass
+
+    json_text = _extract_json_text(text) if isinstance(text, str) else None
+    if json_text is not None:
+        fixes = {"prose"}
+        try:
+            obj, _ = json.JSONDecoder().raw_decode(json_text)
+            return _repaired(obj, fixes)
+        except ValueError:
+            pass
+        fixes = set()
+        for candidate, stack in _scan(json_text, fixes):
+            if "truncated" in fixes and not allow_truncated:
+                _count("failed")
+                raise ValueError("JSON被截断")
+            try:
+                obj, _ = json.JSONDecoder().raw_decode(_close(candidate, stack))
+                if text.strip()[:1] not in "{[":
+                    fixes.add("prose")
+                return _repaired(obj, fixes)
+            except ValueError:
+                continue
+    _count("failed")
+    raise ValueError("JSON无法修复")
+
+
+def _repaired(obj, fixes):
+    _count("repaired")
+    for fix in fixes:
+        _count(fix)
+    return obj
+
+
+def repair_stats():
+    """
+    输出JSON解析结果的计数、修复成功率（修复成功 / 需要修复）和各类修复的次数
+    """
+    stats = {name: _counters[name].value for name in _outcomes}
+    malformed = stats["repaired"] + stats["failed"]
+    stats["repair_rate"] = round(stats["repaired"] / malformed, 4) if malformed else 0.0
+    stats["fixes"] = {name: _counters[name].value for name in _fixes}
+    return stats
@@ -1,10 +1,8 @@
 import re
-import openai
-import os
 from dotenv import load_dotenv
+# .env中的OPENAI_API_BASE / OPENAI_API_KEY需要在导入llm_api之前加载，llm_api按环境变量设置endpoint和key
 load_dotenv(dotenv_path = ".env")
-openai.api_base = os.environ["OPENAI_API_BASE"]
-openai.api_key = os.environ["OPENAI_API_KEY"]
+from llm_api import routed_llm_request, usage_context
 
 
 def pre_handel(latex_content):
@@ -27,17 +25,20 @@ def post_handel(markdown_content):
     markdown_content = re.sub(r"---|```|\'\'\'", r'', markdown_content)
     return markdown_content
 
+def validate_markdown(reply):
+    reply = reply.strip()
+    if not reply.startswith('The markdown format is:'):
+        raise ValueError("unexpected latex2markdown reply")
+    return reply[len('The markdown format is:'):].strip()
+
 def latex2markdown_gpt(latex_content):
     prompt = 'I will give you a code in latex, you should transfer it into markdown format, omitting images, tables, and other non-textual elements. The latex code is:\n\n' + \
         latex_content + '\n\n' + 'You should only output the markdown content without any additional content. You response should begin with: The markdown format is:'
-    completion = openai.ChatCompletion.create(
-        model="gpt-4-1106-preview",
-        messages=[{'role': 'system', 'content': 'you are a helpful assistant. You should fully comply with user instructions.'},
-                {'role': 'user', 'content': prompt}],
-        temperature=0,
-        response_format={"type": 'text'},
-    )
-    return completion.choices[0]["message"]["content"][len('The markdown format is:'):].strip()
+    with usage_context(stage="latex2markdown"):
+        return routed_llm_request(
+            prompt, "latex2markdown", validate_func=validate_markdown, input_text=latex_content,
+            system_content='you are a helpful assistant. You should fully comply with user instructions.'
+        )
 
 def latex2markdown(latex_content, input_type='str'):
     if input_type == 'file':
@@ -0,0 +1,299 @@
+import io
+import os
+import posixpath
+import re
+import zipfile
+from bisect import bisect_right
+
+from latex_sections import get_section_index
+
+# 需要展开的命令：\input、\include、\subfile；注释和verbatim/comment等环境中的命令被忽略
+_include_pattern = re.compile(
+    r"(?P<escape>\\[\\%])"
+    r"|(?P<comment>%[^\n]*)"
+    r"|(?P<verbatim>\\begin\{(?P<env>verbatim|comment|lstlisting|minted)\}.*?\\end\{(?P=env)\})"
+    r"|\\(?P<command>input|include|subfile)(?![A-Za-z])\s*\{(?P<path>[^{}]+)\}",
+    re.DOTALL,
+)
+_comment_pattern = re.compile(r"(?<!\\)%[^\n]*")
+_document_pattern = re.compile(r"\\begin\{document\}(.*)\\end\{document\}", re.DOTALL)
+_main_pattern = re.compile(r"^[^%\n]*\\documentclass(?!\s*(\[[^\]]*\])?\s*\{subfiles\})", re.M)
+
+
+class LatexProjectError(ValueError):
+    """
+    LaTeX项目无法展开时抛出：找不到主文件，或\\input/\\include/\\subfile形成循环引用
+    """
+
+
+class SourceSegment:
+    """
+    展开后的文档中[flat_start, flat_end)这一段来自源文件path中从file_start开始的内容
+    """
+
+    def __init__(self, flat_start, flat_end, path, file_start):
+        self.flat_start = flat_start
+        self.flat_end = flat_end
+        self.path = path
+        self.file_start = file_start
+
+
+class _DirectorySource:
+    def __init__(self, root):
+        self.root = root
+
+    def names(self):
+        ls_name = []
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                ls_name.append(posixpath.normpath(os.path.relpath(os.path.join(dir_path, file_name), self.root).replace(os.sep, "/")))
+        return sorted(ls_name)
+
+    def read_bytes(self, name):
+        path = os.path.join(self.root, *name.split("/"))
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class _ZipSource:
+    def __init__(self, data):
+        self.zip_file = zipfile.ZipFile(io.BytesIO(data) if isinstance(data, bytes) else data)
+        ls_member = [name for name in self.zip_file.namelist() if not name.endswith("/") and not name.startswith("__MACOSX/")]
+        # 压缩包中所有文件都在同一个顶层目录下时，以该目录作为项目根目录
+        prefix = ls_member[0].split("/")[0] + "/" if ls_member and "/" in ls_member[0] else ""
+        if not prefix or not all(name.startswith(prefix) for name in ls_member):
+            prefix = ""
+        self._members = {posixpath.normpath(name[len(prefix):]): name for name in ls_member}
+
+    def names(self):
+        return sorted(self._members.keys())
+
+    def read_bytes(self, name):
+        member = self._members.get(name)
+        if member is None:
+            return None
+        return self.zip_file.read(member)
+
+
+class LatexProject:
+    """
+    由多个文件组成的LaTeX项目：从主文件开始展开\\input、\\include、\\subfile，得到一份完整的文档
+    被引用的文件在展开时才读取，每个文件只读取一次；source_map记录展开后每一段文本来自哪个文件，
+    润色后的章节可以通过write_back写回各自的源文件
+    """
+
+    def __init__(self, source, main_file=None):
+        self.source = source
+        self._texts = {}
+        self._line_starts = {}
+        self.main_file = main_file or self._find_main_file()
+        self.warnings = []
+        self.source_map = None
+        self._flat_text = None
+
+    def read(self, path):
+        """
+        读取项目中的文件（带缓存），文件不存在时返回None
+        """
+        if path not in self._texts:
+            data = self.source.read_bytes(path)
+            if data is None:
+                self._texts[path] = None
+            else:
+                try:
+                    self._texts[path] = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    self._texts[path] = data.decode("latin-1")
+        return self._texts[path]
+
+    def _find_main_file(self):
+        """
+        主文件为包含\\documentclass（且不是subfiles子文件）的.tex文件，优先main.tex，其次目录层级最浅的文件
+        """
+        ls_tex = [name for name in self.source.names() if name.lower().endswith(".tex")]
+        ls_tex.sort(key=lambda name: (posixpath.basename(name).lower() != "main.tex", name.count("/"), name))
+        for name in ls_tex:
+            text = self.read(name)
+            if text is not None and _main_pattern.search(text):
+                return name
+        if len(ls_tex) == 1:
+            return ls_tex[0]
+        raise LatexProjectError("项目中没有找到包含\\documentclass的主文件")
+
+    def _resolve(self, target, current_path, command):
+        """
+        按LaTeX的规则查找被引用的文件：\\input和\\include相对于主文件所在目录，\\subfile相对于当前文件所在目录，
+        找不到时再尝试另一个目录；没有扩展名时优先补上.tex
+        """
+        ls_dir = [posixpath.dirname(self.main_file), posixpath.dirname(current_path)]
+        if command == "subfile":
+            ls_dir.reverse()
+        ls_name = [target] if target.lower().endswith(".tex") else [target + ".tex", target]
+        for dir_name in ls_dir:
+            for name in ls_name:
+                path = posixpath.normpath(posixpath.join(dir_name, name))
+                if path.startswith("../"):
+                    continue
+                if self.read(path) is not None:
+                    return path
+        return None
+
+    def flatten(self):
+        """
+        展开整个项目，返回完整的文档文本，source_map同时生成
+        """
+        if self._flat_text is None:
+            self._ls_piece = []
+            self._flat_len = 0
+            self.source_map = []
+            self.warnings = []
+            main_text = self.read(self.main_file)
+            self._expand(self.main_file, 0, len(main_text), [self.main_file])
+            self._flat_text = "".join(self._ls_piece)
+            self._segment_starts = [segment.flat_start for segment in self.source_map]
+            del self._ls_piece
+        return self._flat_text
+
+    def _emit(self, path, start, end):
+        if start >= end:
+            return
+        self._ls_piece.append(self._texts[path][start:end])
+        self.source_map.append(SourceSegment(self._flat_len, self._flat_len + end - start, path, start))
+        self._flat_len += end - start
+        return
+
+    def _expand(self, path, start, end, stack):
+        text = self.read(path)
+        pos = start
+        for match in _include_pattern.finditer(text, start, end):
+            command = match.group("command")
+            if command is None:
+                continue
+            target = self._resolve(match.group("path").strip(), path, command)
+            if target is None:
+                # 找不到的文件保留原命令
+                self.warnings.append(f"{path}:{self.line_of(path, match.start())} 找不到\\{command}{{{match.group('path')}}}")
+                continue
+            if target in stack:
+                raise LatexProjectError("文件之间存在循环引用: " + " -> ".join(stack + [target]))
+            self._emit(path, pos, match.start())
+            target_text = self.read(target)
+            target_start, target_end = 0, len(target_text)
+            if command == "subfile":
+                # 子文件是独立的文档，只取\begin{document}和\end{document}之间的内容
+                document_match = _document_pattern.search(target_text)
+                if document_match:
+                    target_start, target_end = document_match.span(1)
+            self._expand(target, target_start, target_end, stack + [target])
+            pos = match.end()
+        self._emit(path, pos, end)
+        return
+
+    def line_of(self, path, file_offset):
+        if path not in self._line_starts:
+            self._line_starts[path] = [0] + [match.end() for match in re.finditer("\n", self.read(path))]
+        return bisect_right(self._line_starts[path], file_offset)
+
+    def locate(self, flat_offset):
+        """
+        返回展开后文档中flat_offset处的文本所在的(源文件, 行号)
+        """
+        self.flatten()
+        i = bisect_right(self._segment_starts, flat_offset) - 1
+        if i < 0:
+            return None
+        segment = self.source_map[i]
+        file_offset = segment.file_start + min(flat_offset, segment.flat_end) - segment.flat_start
+        return segment.path, self.line_of(segment.path, file_offset)
+
+    def _map_range(self, flat_start, flat_end):
+        """
+        将展开后文档中的区间[flat_start, flat_end)拆分成各源文件中的区间[(segment, 起始, 结束)]（展开后文档中的位置）
+        """
+        ls_range = []
+        i = max(bisect_right(self._segment_starts, flat_start) - 1, 0)
+        while i < len(self.source_map) and self.source_map[i].flat_start < flat_end:
+            segment = self.source_map[i]
+            start, end = max(flat_start, segment.flat_start), min(flat_end, segment.flat_end)
+            if start < end:
+                ls_range.append((segment, start, end))
+            i += 1
+        return ls_range
+
+    def write_back(self, dt_new_content):
+        """
+        将{section_label: 新正文}写回各章节所在的源文件，返回({文件: 修改后的全文}, 无法写回的section_label列表)
+        章节正文跨越多个文件（正文中间有\\input或未展开的命令）时无法确定如何拆分，不写回
+        """
+        flat_text = self.flatten()
+        section_index = get_section_index(flat_text)
+        dt_edit = {}
+        ls_skipped = []
+        for section_label, new_content in dt_new_content.items():
+            node = section_index.get(section_label)
+            if node is None:
+                ls_skipped.append(section_label)
+                continue
+            ls_range = self._map_range(node.content_start, node.content_end)
+            # 正文前后只含空白和注释的片段（如两个\input之间的换行）保留在原文件中
+            ls_text_range = [item for item in ls_range if _comment_pattern.sub("", flat_text[item[1] : item[2]]).strip()]
+            if len(ls_text_range) > 1:
+                ls_skipped.append(section_label)
+                continue
+            if ls_text_range:
+                segment, start, end = ls_text_range[0]
+            elif ls_range:
+                segment, start, end = ls_range[0]
+            else:
+                segment, start, end = self._map_range(node.content_start - 1, node.content_start)[0]
+                start = end = node.content_start
+            file_start = segment.file_start + start - segment.flat_start
+            file_end = segment.file_start + end - segment.flat_start
+            dt_edit.setdefault(segment.path, []).append((file_start, file_end, "\n" + new_content + "\n"))
+
+        dt_file_text = {}
+        for path, ls_edit in dt_edit.items():
+            text = self.read(path)
+            for file_start, file_end, new_text in sorted(ls_edit, reverse=True):
+                text = text[:file_start] + new_text + text[file_end:]
+            dt_file_text[path] = text
+        return dt_file_text, ls_skipped
+
+    def export_zip(self, dt_file_text=None):
+        """
+        将整个项目（用dt_file_text替换修改过的文件）打包成zip，返回bytes
+        """
+        dt_file_text = dt_file_text or {}
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for name in self.source.names():
+                if name in dt_file_text:
+                    zip_file.writestr(name, dt_file_text[name].encode("utf-8"))
+                else:
+                    zip_file.writestr(name, self.source.read_bytes(name))
+        return buffer.getvalue()
+
+    def save(self, dt_file_text, output_dir):
+        """
+        将修改过的文件写入output_dir（保持项目内的相对路径）
+        """
+        for name, text in dt_file_text.items():
+            path = os.path.join(output_dir, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return
+
+
+def load_latex_project(source, main_file=None):
+    """
+    加载LaTeX项目：source为项目目录、.zip文件路径、zip文件的bytes或文件对象；main_file为项目内主文件的相对路径（默认自动查找）
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        return LatexProject(_DirectorySource(source), main_file)
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return LatexProject(_ZipSource(f.read()), main_file)
+    return LatexProject(_ZipSource(source), main_file)
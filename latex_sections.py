@@ -0,0 +1,203 @@
+import re
+import threading
+from collections import OrderedDict
+from hashlib import md5
+
+# 章节命令对应的层级，\section*等带星号的命令与不带星号的层级相同
+section_levels = {"chapter": 0, "section": 1, "subsection": 2, "subsubsection": 3}
+
+# 一次扫描需要识别的记号：转义字符、注释、不排版的环境、文档结尾和章节命令
+_token_pattern = re.compile(
+    r"(?P<escape>\\[\\%])"
+    r"|(?P<comment>%[^\n]*)"
+    r"|(?P<verbatim>\\begin\{(?P<env>verbatim|comment|lstlisting|minted)\}.*?\\end\{(?P=env)\})"
+    r"|(?P<end>\\end\{document\})"
+    r"|\\(?P<command>chapter|subsubsection|subsection|section)(?![A-Za-z])(?P<star>\*?)",
+    re.DOTALL,
+)
+
+_index_cache = OrderedDict()
+_index_cache_size = 8
+_index_cache_lock = threading.Lock()
+
+
+class SectionNode:
+    """
+    章节树中的一个节点，偏移量均为在文档字符串中的字符位置：
+    start为章节命令的起始位置，content_start为标题之后正文的起始位置，
+    content_end为下一个章节命令（或文档结尾）的位置，end为包含所有子章节在内的结束位置
+    """
+
+    def __init__(self, title, level, starred, start, content_start):
+        self.title = title
+        self.level = level
+        self.starred = starred
+        self.start = start
+        self.content_start = content_start
+        self.content_end = None
+        self.end = None
+        # id由各级标题组成，只依赖文档大纲，正文修改后保持不变；label为全文唯一的章节名，重名的章节加上序号
+        self.id = None
+        self.label = None
+        self.parent = None
+        self.children = []
+
+
+def _skip_spaces(text, i):
+    while i < len(text) and text[i] in " \t\r\n":
+        i += 1
+    return i
+
+
+def _read_group(text, i, opener, closer):
+    """
+    读取从text[i]开始的括号组（允许嵌套），返回(括号内的文本, 结束位置)，text[i]不是opener或括号未闭合时返回(None, i)
+    """
+    if i >= len(text) or text[i] != opener:
+        return None, i
+    depth = 0
+    j = i
+    while j < len(text):
+        char = text[j]
+        if char == "\\":
+            j += 2
+            continue
+        if char == opener:
+            depth += 1
+        elif char == closer:
+            depth -= 1
+            if depth == 0:
+                return text[i + 1 : j], j + 1
+        j += 1
+    return None, i
+
+
+def _slug(title):
+    return re.sub(r"[^a-z0-9]+", "-", title.lower()).strip("-") or "section"
+
+
+class SectionIndex:
+    """
+    LaTeX文档的章节树：nodes按文档顺序排列，roots为最上层的章节
+    """
+
+    def __init__(self, text, nodes, document_end):
+        self.text = text
+        self.nodes = nodes
+        self.document_end = document_end
+        self.roots = [node for node in nodes if node.parent is None]
+        self._by_label = {node.label: node for node in nodes}
+        self._by_id = {node.id: node for node in nodes}
+
+    def get(self, label):
+        return self._by_label.get(label)
+
+    def get_by_id(self, node_id):
+        return self._by_id.get(node_id)
+
+    def content(self, node):
+        """
+        章节自身的正文（不含子章节）
+        """
+        return self.text[node.content_start : node.content_end]
+
+    def section_contents(self):
+        """
+        按文档顺序返回{label: 正文}，只保留正文非空的章节（包含子章节的章节只有在子章节之前有正文时才保留）
+        """
+        dt_section = {}
+        for node in self.nodes:
+            content = self.content(node).strip()
+            if content:
+                dt_section[node.label] = content
+        return dt_section
+
+    def replace_contents(self, dt_new_content):
+        """
+        将dt_new_content中各章节（按label）的正文替换为新内容，章节命令和子章节保持不变，一次拼接生成新文档
+        不存在的label被忽略
+        """
+        ls_piece = []
+        last_end = 0
+        for node in self.nodes:
+            if node.label not in dt_new_content:
+                continue
+            ls_piece += [self.text[last_end : node.content_start], "\n", dt_new_content[node.label], "\n"]
+            last_end = node.content_end
+        ls_piece.append(self.text[last_end:])
+        return "".join(ls_piece)
+
+
+def parse_section_tree(latex_text):
+    """
+    一次扫描LaTeX文档，建立包含\\chapter、\\section、\\subsection、\\subsubsection（及带星号版本）的章节树
+    注释、verbatim/comment等环境中的章节命令被忽略，\\end{document}之后的内容不属于任何章节
+    """
+    nodes = []
+    stack = []
+    dt_label_num = {}
+    dt_id_num = {}
+    document_end = len(latex_text)
+    i = 0
+    while True:
+        match = _token_pattern.search(latex_text, i)
+        if match is None:
+            break
+        i = match.end()
+        if match.group("end"):
+            document_end = match.start()
+            break
+        command = match.group("command")
+        if command is None:
+            continue
+        # \section[短标题]{标题}
+        j = _skip_spaces(latex_text, i)
+        if j < len(latex_text) and latex_text[j] == "[":
+            _, j = _read_group(latex_text, j, "[", "]")
+            j = _skip_spaces(latex_text, j)
+        title, j = _read_group(latex_text, j, "{", "}")
+        if title is None:
+            continue
+        i = j
+
+        node = SectionNode(re.sub(r"\s+", " ", title).strip(), section_levels[command], bool(match.group("star")), match.start(), j)
+        if nodes:
+            nodes[-1].content_end = node.start
+        while stack and stack[-1].level >= node.level:
+            stack.pop().end = node.start
+        if stack:
+            node.parent = stack[-1]
+            node.parent.children.append(node)
+
+        dt_label_num[node.title] = dt_label_num.get(node.title, 0) + 1
+        node.label = node.title if dt_label_num[node.title] == 1 else f"{node.title} ({dt_label_num[node.title]})"
+        node_id = (node.parent.id + "/" if node.parent else "") + _slug(node.title)
+        dt_id_num[node_id] = dt_id_num.get(node_id, 0) + 1
+        node.id = node_id if dt_id_num[node_id] == 1 else f"{node_id}-{dt_id_num[node_id]}"
+
+        nodes.append(node)
+        stack.append(node)
+
+    if nodes:
+        nodes[-1].content_end = document_end
+    for node in stack:
+        node.end = document_end
+    return SectionIndex(latex_text, nodes, document_end)
+
+
+def get_section_index(latex_text):
+    """
+    获取文档的章节树，最近解析过的文档按内容hash复用，抽取章节、替换章节内容和页面展示共用同一份解析结果
+    """
+    key = md5(latex_text.encode("utf-8")).hexdigest()
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+        if index is not None:
+            _index_cache.move_to_end(key)
+            return index
+    index = parse_section_tree(latex_text)
+    with _index_cache_lock:
+        _index_cache[key] = index
+        if len(_index_cache) > _index_cache_size:
+            _index_cache.popitem(last=False)
+    return index
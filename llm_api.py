@@ -1,28 +1,134 @@
 from datetime import datetime, timedelta
 from joblib import Parallel, delayed
+import asyncio
+import concurrent.futures
+import contextvars
 import logging
+import multiprocessing
+import queue
+import random
+import threading
 import time
 import traceback
+import uuid
+from contextlib import asynccontextmanager, contextmanager
 from hashlib import md5
 import json
 import numpy as np
 import openai
 import re
+import sqlite3
 
 import os
-import tiktoken
 from langchain.embeddings import OpenAIEmbeddings
 
-
-openai_api_base = "http://27.102.66.157:8000/v1"
-with open("../openai_key", "r") as f:
-    openai_api_key = f.read().strip()
+from conversation_memory import ConversationMemory, SummarizeStrategy
+from json_repair import repair_json, repair_stats
+from token_counter import PromptTooLongError, check_prompt_budget, count_messages_tokens, count_tokens, tokens_per_message
+
+
+# 大模型endpoint和key：环境变量OPENAI_API_BASE / OPENAI_API_KEY优先（如通过.env加载），
+# 未设置时使用默认endpoint和../openai_key文件中的key
+openai_api_base = os.environ.get("OPENAI_API_BASE", "http://27.102.66.157:8000/v1")
+# 设置STOCHASTICGPT_MOCK_LLM（如http://127.0.0.1:8765/v1）时改为请求本地的mock_llm_server，不需要key文件
+mock_llm_api_base = os.environ.get("STOCHASTICGPT_MOCK_LLM")
+if mock_llm_api_base:
+    openai_api_base = mock_llm_api_base
+    openai_api_key = "mock"
+elif os.environ.get("OPENAI_API_KEY"):
+    openai_api_key = os.environ["OPENAI_API_KEY"]
+else:
+    with open("../openai_key", "r") as f:
+        openai_api_key = f.read().strip()
 openai.api_base = openai_api_base
 openai.api_key = openai_api_key
-# from dotenv import load_dotenv
-# load_dotenv(dotenv_path = ".env")
-# openai.api_base = os.environ["OPENAI_API_BASE"]
-# openai.api_key = os.environ["OPENAI_API_KEY"]
+# 回复缓存、限流状态、用量记录和embedding缓存所在的目录；mock模式使用单独的目录，不与真实请求的记录混在一起
+record_dir = "./record/mock" if mock_llm_api_base else "./record"
+
+# 大模型请求的连接超时和读取超时（秒），流式请求的读取超时为相邻两个片段之间的最长间隔
+llm_connect_timeout = 10
+llm_read_timeout = 180
+
+# 同步接口共用的后台事件循环（按进程创建，fork出的子进程会重新创建）
+_background_loop = None
+_background_loop_pid = None
+_background_loop_lock = threading.Lock()
+
+# 各模型每1000个token的费用：(prompt, completion)
+token_fee_dict = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+# 用量记录的上下文：当前处理的论文和流水线阶段
+_usage_paper_id = contextvars.ContextVar("usage_paper_id", default=None)
+_usage_stage = contextvars.ContextVar("usage_stage", default=None)
+_usage_route = contextvars.ContextVar("usage_route", default=(None, None))
+
+# 当前流水线运行的重试预算，见retry_scope
+_retry_policy = contextvars.ContextVar("retry_policy", default=None)
+# 当前流水线运行的取消令牌，见cancel_scope
+_cancel_token = contextvars.ContextVar("cancel_token", default=None)
+
+# 模型路由表：任务类型 -> [(输入token数上限, 模型)]，按顺序取第一个满足上限的模型，上限为None表示不限长度
+# 表中没有的任务类型使用default_llm_model
+default_llm_model = "gpt-4-1106-preview"
+model_route_table = {
+    "section_structure": [(1500, "gpt-3.5-turbo-1106"), (None, "gpt-4-1106-preview")],
+    "section_analysis": [(800, "gpt-3.5-turbo-1106"), (None, "gpt-4-1106-preview")],
+    "latex2markdown": [(3000, "gpt-3.5-turbo-1106"), (None, "gpt-4-1106-preview")],
+}
+# 回复校验失败时按此顺序升级到更大的模型
+model_escalation_order = ["gpt-3.5-turbo-1106", "gpt-4-1106-preview"]
+
+# 大模型回复缓存，设置环境变量STOCHASTICGPT_LLM_CACHE=0可全局关闭；mock模式下默认关闭（压测需要每次都请求mock），设为1时打开
+llm_cache_enabled = os.environ.get("STOCHASTICGPT_LLM_CACHE", "0" if mock_llm_api_base else "1") != "0"
+
+
+def set_llm_endpoint(api_base=None, api_key=None):
+    """
+    设置大模型请求使用的endpoint和key
+    """
+    if api_base is not None:
+        openai.api_base = api_base
+    if api_key is not None:
+        openai.api_key = api_key
+    return
+
+
+def use_mock_llm(api_base="http://127.0.0.1:8765/v1"):
+    """
+    将后续的大模型请求指向本地的mock_llm_server（也可以在启动前设置环境变量STOCHASTICGPT_MOCK_LLM）
+    缓存和用量记录切换到mock专用的目录，回复缓存按STOCHASTICGPT_LLM_CACHE的mock模式默认值关闭
+    """
+    global llm_cache_enabled
+    openai.api_base = api_base
+    openai.api_key = "mock"
+    llm_cache_enabled = os.environ.get("STOCHASTICGPT_LLM_CACHE", "0") != "0"
+    set_record_dir("./record/mock")
+    return
+
+
+def set_record_dir(new_record_dir):
+    """
+    切换回复缓存、限流状态、用量记录和embedding缓存所在的目录，已打开的连接在下次使用时重新建立
+    """
+    global record_dir
+    record_dir = new_record_dir
+    for store, file_name in [(llm_cache, "llm_cache.sqlite"), (rate_limiter, "rate_limit.sqlite"), (usage_ledger, "usage.sqlite")]:
+        with store._lock:
+            store.db_path = os.path.join(record_dir, file_name)
+            store._conn = None
+    with embedding_store._lock:
+        embedding_store.cache_dir = os.path.join(record_dir, "embedding_cache")
+        embedding_store.vector_path = os.path.join(embedding_store.cache_dir, "vectors.f32")
+        embedding_store.index_path = os.path.join(embedding_store.cache_dir, "index.sqlite")
+        embedding_store._conn = None
+        embedding_store._matrix = None
+    return
 
 
 def get_date(date0, days):
@@ -130,26 +236,16 @@ def parse_numbers(text):
 
 def parse_json(text, key=None):
     """
-    直接利用json.loads解析字符串
+    解析字符串中的JSON，无法直接解析时先在本地修复（代码块、尾随逗号、截断等），修复失败才抛出AssertionError
     """
     try:
-        json_obj = json.loads(text)
+        json_obj = repair_json(text)
         if key is not None:
             json_obj = json_obj[key]
         return json_obj
 
-    except:
-        try:
-            pattern = re.compile(r"```json\n([\s\S]*?)\n```")
-            match = pattern.search(text)
-            json_text = match.group(1)
-            json_obj = json.loads(json_text)
-            if key is not None:
-                json_obj = json_obj[key]
-            return json_obj
-
-        except BaseException as error:
-            raise AssertionError(f"JSON解析失败 {error}\n{text}")
+    except BaseException as error:
+        raise AssertionError(f"JSON解析失败 {error}\n{text}")
 
 
 def parse_func(fun_str):
@@ -224,106 +320,1452 @@ def calc_tokens_num_from_text(text):
     """
     统计文本中的token数量
     """
-    num_tokens = len(tiktoken.encoding_for_model("gpt-4").encode(text))
+    num_tokens = count_tokens(text, "gpt-4")
     return num_tokens
 
 
-class GPT:
-    def __init__(self):
-        self.fee_path = "./record/fee.json"
-        self.max_try_num = 3
-        self.token_fee_dict = {
-            "gpt-4": (0.03, 0.06),
-            "gpt-4-1106-preview": (0.01, 0.03),
-            "gpt-3.5-turbo": (0.0015, 0.002),
-            "gpt-3.5-turbo-1106": (0.001, 0.002),
-            "text-embedding-ada-002": (0.0001, 0.0),
+def set_llm_concurrency(max_concurrency=None, min_concurrency=None, initial_concurrency=None):
+    """
+    设置自适应并发上限的调整范围，max_concurrency和min_concurrency相同时即为固定并发
+    """
+    llm_concurrency.configure(max_limit=max_concurrency, min_limit=min_concurrency, limit=initial_concurrency)
+    return
+
+
+def set_llm_timeout(connect_timeout=None, read_timeout=None):
+    """
+    设置大模型请求的连接超时和读取超时（秒）
+    """
+    global llm_connect_timeout, llm_read_timeout
+    if connect_timeout is not None:
+        llm_connect_timeout = connect_timeout
+    if read_timeout is not None:
+        llm_read_timeout = read_timeout
+    return
+
+
+def _get_background_loop():
+    """
+    获取（必要时启动）运行在守护线程中的后台事件循环
+    """
+    global _background_loop, _background_loop_pid
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="llm_event_loop", daemon=True)
+            thread.start()
+            _background_loop = loop
+            _background_loop_pid = os.getpid()
+    return _background_loop
+
+
+def submit_coroutine(coro):
+    """
+    将协程提交到后台事件循环执行，返回(concurrent.futures.Future, cancel函数)
+    调用方的contextvars会随协程一起传递
+    """
+    loop = _get_background_loop()
+    ctx = contextvars.copy_context()
+    future = concurrent.futures.Future()
+    tasks = []
+
+    def on_done(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        task = ctx.run(loop.create_task, coro)
+        task.add_done_callback(on_done)
+        tasks.append(task)
+
+    def cancel():
+        loop.call_soon_threadsafe(lambda: [task.cancel() for task in tasks])
+
+    loop.call_soon_threadsafe(start)
+    return future, cancel
+
+
+def run_coroutine_sync(coro):
+    """
+    在后台事件循环中执行协程并阻塞等待结果
+    所有同步接口共用同一个事件循环
+    """
+    future, cancel = submit_coroutine(coro)
+    try:
+        return future.result()
+    finally:
+        if not future.done():
+            cancel()
+
+
+def iterate_async_generator_sync(async_generator):
+    """
+    在后台事件循环中消费异步生成器，返回同步生成器
+    异步生成器在调用时即开始执行；同步生成器被提前关闭时会取消后台任务
+    """
+    items = queue.Queue()
+    end_flag = object()
+
+    async def pump():
+        try:
+            async for item in async_generator:
+                items.put((item, None))
+        except BaseException as error:
+            items.put((end_flag, error))
+            raise
+        finally:
+            await async_generator.aclose()
+        items.put((end_flag, None))
+
+    future, cancel = submit_coroutine(pump())
+
+    def generator():
+        try:
+            while True:
+                item, error = items.get()
+                if item is end_flag:
+                    if error is not None and not isinstance(error, asyncio.CancelledError):
+                        raise error
+                    return
+                yield item
+        finally:
+            if not future.done():
+                cancel()
+
+    return generator()
+
+
+async def _run_blocking(func, *args):
+    """
+    在事件循环的默认线程池中执行阻塞调用（缓存、限流和用量记录的SQLite读写），contextvars（用量记录的论文和阶段）随调用传递
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+
+class LLMCache:
+    """
+    基于SQLite的大模型回复缓存
+    key为模型、消息（含system content）、温度、response_format等请求参数的hash，按最近访问时间做LRU淘汰，并支持过期时间
+    """
+
+    def __init__(self, db_path="./record/llm_cache.sqlite", max_bytes=256 * 1024 * 1024, ttl=30 * 24 * 3600):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evict_interval = 100
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _connect(self):
+        """
+        获取当前进程的数据库连接（SQLite连接不能跨fork复用）
+        """
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, reply TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed)")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def make_key(llm_model, messages, temperature, response_type, max_tokens=None):
+        """
+        计算请求的缓存key，包含当前的endpoint，不同endpoint（如mock_llm_server）的回复不会互相命中
+        """
+        payload = {
+            "api_base": openai.api_base,
+            "model": llm_model,
+            "messages": messages,
+            "temperature": temperature,
+            "response_format": response_type,
+            "max_tokens": max_tokens,
         }
-        self.llm_system_content = "Assuming you are an expert in English paper polishing."
-        self.reset_conversation()
+        return hashcode(json.dumps(payload, sort_keys=True, ensure_ascii=False))
 
-    def _record_fee(self, prompt_tokens, completion_tokens, llm_model):
+    def get(self, key):
         """
-        记录大模型费用
+        读取缓存，未命中或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT reply, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            reply, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return reply
+
+    def set(self, key, reply):
+        """
+        写入缓存，每写入evict_interval次检查一次容量
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, reply, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                (key, reply, now, now, len(reply.encode("utf-8"))),
+            )
+            self._writes += 1
+            need_evict = self._writes % self.evict_interval == 0
+        if need_evict:
+            self.evict()
+        return
+
+    def evict(self):
+        """
+        删除过期条目，并按最近访问时间淘汰条目直到总大小不超过max_bytes
         """
+        with self._lock:
+            conn = self._connect()
+            if self.ttl is not None:
+                conn.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,))
+            total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+            if total_size <= self.max_bytes:
+                return
+            ls_key = []
+            for key, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed ASC"):
+                if total_size <= self.max_bytes:
+                    break
+                ls_key.append((key,))
+                total_size -= size
+            conn.executemany("DELETE FROM llm_cache WHERE key = ?", ls_key)
+        return
 
-        request_fee_per_token = self.token_fee_dict[llm_model][0]
-        reply_fee_per_token = self.token_fee_dict[llm_model][1]
+    def clear(self):
+        """
+        清空缓存
+        """
+        with self._lock:
+            self._connect().execute("DELETE FROM llm_cache")
+        return
 
-        prompt_fee = prompt_tokens * request_fee_per_token / 1000
-        completion_fee = completion_tokens * reply_fee_per_token / 1000
+    def stats(self):
+        """
+        输出缓存命中情况和容量
+        """
+        with self._lock:
+            entries, total_size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total_size}
 
-        fee = round(prompt_fee + completion_fee, 3)
-        try:
-            info = load_json(self.fee_path)
-        except:
-            info = {"fee": 0.0}
-        info["fee"] += fee
-        info["fee"] = round(info["fee"], 3)
-        save_json(info, self.fee_path)
+
+llm_cache = LLMCache(db_path=os.path.join(record_dir, "llm_cache.sqlite"))
+
+
+class RateLimiter:
+    """
+    按模型区分的令牌桶限流器，同时约束每分钟请求数（RPM）和每分钟token数（TPM）
+    桶的状态保存在SQLite中并通过事务原子更新，因此在util.multiprocess启动的多个进程和多个线程之间共享
+    """
+
+    def __init__(self, db_path="./record/rate_limit.sqlite"):
+        self.db_path = db_path
+        # 模型 -> (RPM, TPM)
+        self.rate_limit_dict = {
+            "gpt-4": (500, 40000),
+            "gpt-4-1106-preview": (500, 150000),
+            "gpt-3.5-turbo": (3500, 160000),
+            "gpt-3.5-turbo-1106": (3500, 160000),
+            "text-embedding-ada-002": (3000, 1000000),
+        }
+        self.default_rate_limit = (500, 90000)
+        # 未指定max_tokens时对回复长度的估计
+        self.default_completion_tokens = 500
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _connect(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit "
+                "(model TEXT PRIMARY KEY, request_budget REAL NOT NULL, token_budget REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def set_rate_limit(self, llm_model, rpm, tpm):
+        self.rate_limit_dict[llm_model] = (rpm, tpm)
         return
 
-    def _request(self, messages, llm_model, temperature, response_type, max_tokens=None):
+    def estimate_tokens(self, messages, max_tokens=None):
         """
-        使用大模型生成回复
+        估计一次请求消耗的token数量：prompt的token数 + 回复的token上限（或估计值）
         """
+        prompt_tokens = count_messages_tokens(messages)
+        completion_tokens = max_tokens if max_tokens is not None else self.default_completion_tokens
+        return prompt_tokens + completion_tokens
 
-        for _ in range(self.max_try_num):
+    def _consume(self, llm_model, tokens):
+        """
+        尝试从令牌桶中扣除一次请求和tokens个token
+        成功时返回0，否则返回需要等待的秒数（不扣除）
+        """
+        rpm, tpm = self.rate_limit_dict.get(llm_model, self.default_rate_limit)
+        # 单次请求超过桶容量时，等桶满即可放行
+        tokens = min(tokens, tpm)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
             try:
-                completion = openai.ChatCompletion.create(
-                    model=llm_model,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    messages=messages,
-                    response_format={"type": response_type},
+                row = conn.execute("SELECT request_budget, token_budget, updated FROM rate_limit WHERE model = ?", (llm_model,)).fetchone()
+                if row is None:
+                    request_budget, token_budget = float(rpm), float(tpm)
+                else:
+                    elapsed = max(now - row[2], 0.0)
+                    request_budget = min(float(rpm), row[0] + elapsed * rpm / 60)
+                    token_budget = min(float(tpm), row[1] + elapsed * tpm / 60)
+
+                if request_budget >= 1 and token_budget >= tokens:
+                    request_budget -= 1
+                    token_budget -= tokens
+                    wait = 0.0
+                else:
+                    wait = max((1 - request_budget) * 60 / rpm, (tokens - token_budget) * 60 / tpm, 0.0)
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit (model, request_budget, token_budget, updated) VALUES (?, ?, ?, ?)",
+                    (llm_model, request_budget, token_budget, now),
                 )
-                reply = completion.choices[0]["message"]["content"]
-                token_num = completion.usage.to_dict()
-                self._record_fee(token_num["prompt_tokens"], token_num["completion_tokens"], llm_model)
-                return reply
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
 
-            except openai.error.APIConnectionError:
-                time.sleep(3)
-            except openai.error.RateLimitError:
-                time.sleep(60)
-            except BaseException as error:
-                logging.error(f"大模型调用失败: \n{error}")
-                time.sleep(10)
-        return None
+    def settle(self, llm_model, estimated_tokens, actual_tokens):
+        """
+        请求完成后用实际token数修正预扣的估计值
+        """
+        rpm, tpm = self.rate_limit_dict.get(llm_model, self.default_rate_limit)
+        with self._lock:
+            self._connect().execute(
+                "UPDATE rate_limit SET token_budget = MIN(?, token_budget + ?) WHERE model = ?",
+                (float(tpm), float(estimated_tokens - actual_tokens), llm_model),
+            )
+        return
 
-    def embedding(self, text):
+    def acquire(self, llm_model, tokens):
         """
-        使用大模型计算文本的嵌入
+        阻塞直到令牌桶中有足够的额度
         """
-        text = info_to_text(text)
-        embedding_model = "text-embedding-ada-002"
-        for _ in range(self.max_try_num):
+        while True:
+            wait = self._consume(llm_model, tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait + random.uniform(0, 0.1))
+
+    async def async_acquire(self, llm_model, tokens):
+        """
+        acquire的异步版本，等待期间不阻塞事件循环；访问SQLite（可能等待其他进程的写锁）在线程池中执行
+        """
+        while True:
+            wait = await _run_blocking(self._consume, llm_model, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait + random.uniform(0, 0.1))
+
+
+rate_limiter = RateLimiter(db_path=os.path.join(record_dir, "rate_limit.sqlite"))
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """
+    带随机抖动的指数退避时间（full jitter），避免多个worker在同一时刻重试
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryBudgetExhausted(Exception):
+    """
+    一次流水线运行的重试预算（重试次数或截止时间）用尽时抛出，调用方不应再重试
+    """
+
+
+class RetryPolicy:
+    """
+    一次流水线运行共享的重试预算：重试次数上限和总截止时间
+    请求层（每次失败后重新请求）和调用方（解析失败后重新请求）的每次重试都消耗同一份预算
+    已重试次数保存在共享内存中，fork出的子进程消耗同一份预算
+    """
+
+    def __init__(self, max_retries=30, timeout=None):
+        self.max_retries = max_retries
+        # timeout为None时不设截止时间
+        self.deadline = None if timeout is None else time.time() + timeout
+        self._retries = multiprocessing.Value("i", 0)
+
+    @property
+    def retries(self):
+        return self._retries.value
+
+    def remaining_time(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def check_deadline(self):
+        remaining_time = self.remaining_time()
+        if remaining_time is not None and remaining_time <= 0:
+            raise RetryBudgetExhausted(f"超过截止时间（已重试{self.retries}次）")
+        return
+
+    def consume(self):
+        """
+        消耗一次重试，预算用尽时抛出RetryBudgetExhausted
+        """
+        self.check_deadline()
+        with self._retries.get_lock():
+            if self._retries.value >= self.max_retries:
+                raise RetryBudgetExhausted(f"重试次数达到上限{self.max_retries}")
+            self._retries.value += 1
+        return
+
+    def cap_delay(self, delay):
+        """
+        退避等待不能越过截止时间，剩余时间不足以等待时直接抛出RetryBudgetExhausted
+        """
+        remaining_time = self.remaining_time()
+        if remaining_time is not None and remaining_time <= delay:
+            raise RetryBudgetExhausted(f"剩余时间{max(remaining_time, 0):.1f}s不足以再次重试")
+        return delay
+
+
+@contextmanager
+def retry_scope(policy=None, max_retries=30, timeout=None):
+    """
+    为其中的大模型调用设置共享的重试预算；已在retry_scope中时沿用外层的预算
+    """
+    if _retry_policy.get() is not None and policy is None:
+        yield _retry_policy.get()
+        return
+    policy = policy if policy is not None else RetryPolicy(max_retries=max_retries, timeout=timeout)
+    token = _retry_policy.set(policy)
+    try:
+        yield policy
+    finally:
+        _retry_policy.reset(token)
+
+
+def consume_retry():
+    """
+    调用方重试前调用，消耗当前重试预算中的一次重试（不在retry_scope中时不做限制）
+    """
+    policy = _retry_policy.get()
+    if policy is not None:
+        policy.consume()
+    return
+
+
+def retry_delay(delay):
+    """
+    按当前重试预算的截止时间截断退避等待时间
+    """
+    policy = _retry_policy.get()
+    if policy is not None:
+        return policy.cap_delay(delay)
+    return delay
+
+
+class LLMCancelled(Exception):
+    """
+    当前流水线运行被取消（如页面上点击了Stop processing）时由大模型调用抛出
+    """
+
+
+class CancelToken:
+    """
+    协作式取消令牌：cancel()后，cancel_scope中尚未完成的大模型请求会被中断并抛出LLMCancelled
+    基于multiprocessing.Event，fork出的子进程共享同一个令牌
+    """
+
+    def __init__(self):
+        self._event = multiprocessing.Event()
+
+    def cancel(self):
+        self._event.set()
+        return
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+@contextmanager
+def cancel_scope(token):
+    """
+    使其中的大模型调用可以通过token取消
+    """
+    context_token = _cancel_token.set(token)
+    try:
+        yield token
+    finally:
+        _cancel_token.reset(context_token)
+
+
+def check_cancelled():
+    """
+    当前取消令牌已触发时抛出LLMCancelled
+    """
+    token = _cancel_token.get()
+    if token is not None and token.cancelled:
+        raise LLMCancelled()
+    return
+
+
+async def _await_cancellable(awaitable, timeout=None):
+    """
+    等待awaitable完成：超过timeout秒抛出asyncio.TimeoutError，取消令牌触发时中断等待并抛出LLMCancelled
+    """
+    token = _cancel_token.get()
+    task = asyncio.ensure_future(awaitable)
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        while True:
+            # 有取消令牌时每0.2秒检查一次
+            wait = 0.2 if token is not None else None
+            if deadline is not None:
+                remaining_time = max(deadline - time.time(), 0)
+                wait = remaining_time if wait is None else min(wait, remaining_time)
+            done, _ = await asyncio.wait({task}, timeout=wait)
+            if done:
+                return task.result()
+            check_cancelled()
+            if deadline is not None and time.time() >= deadline:
+                raise asyncio.TimeoutError()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def calc_fee(prompt_tokens, completion_tokens, llm_model):
+    """
+    按token_fee_dict计算一次请求的费用（美元），未知模型记为0
+    """
+    if llm_model not in token_fee_dict:
+        return 0.0
+    request_fee_per_token, reply_fee_per_token = token_fee_dict[llm_model]
+    return prompt_tokens * request_fee_per_token / 1000 + completion_tokens * reply_fee_per_token / 1000
+
+
+@contextmanager
+def usage_context(paper_id=None, stage=None):
+    """
+    设置后续大模型调用在用量记录中所属的论文和流水线阶段，未指定的字段沿用外层设置
+    """
+    tokens = []
+    if paper_id is not None:
+        tokens.append((_usage_paper_id, _usage_paper_id.set(paper_id)))
+    if stage is not None:
+        tokens.append((_usage_stage, _usage_stage.set(stage)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class UsageLedger:
+    """
+    只追加的大模型用量记录，基于WAL模式的SQLite，多进程并发写入不会丢失记录
+    每次调用记录模型、prompt/completion token数、耗时、费用、论文id和流水线阶段
+    """
+
+    group_columns = {"paper": "paper_id", "stage": "stage", "day": "day", "model": "model"}
+
+    def __init__(self, db_path="./record/usage.sqlite"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _connect(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, day TEXT NOT NULL, model TEXT NOT NULL, "
+                "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, latency REAL NOT NULL, cost REAL NOT NULL, "
+                "paper_id TEXT, stage TEXT)"
+            )
+            # 模型路由相关的列：同一次路由请求（含升级重试）共享route_id，routed_from为路由前的默认模型
+            exist_columns = [row[1] for row in conn.execute("PRAGMA table_info(usage)").fetchall()]
+            for column in ["route_id", "routed_from"]:
+                if column not in exist_columns:
+                    conn.execute(f"ALTER TABLE usage ADD COLUMN {column} TEXT")
+            for column in ["paper_id", "stage", "day", "route_id"]:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_usage_{column} ON usage ({column})")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def record(self, llm_model, prompt_tokens, completion_tokens, latency, paper_id=None, stage=None):
+        """
+        追加一条用量记录，paper_id和stage默认取自usage_context
+        """
+        now = time.time()
+        cost = calc_fee(prompt_tokens, completion_tokens, llm_model)
+        paper_id = paper_id if paper_id is not None else _usage_paper_id.get()
+        stage = stage if stage is not None else _usage_stage.get()
+        route_id, routed_from = _usage_route.get()
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO usage (ts, day, model, prompt_tokens, completion_tokens, latency, cost, paper_id, stage, route_id, routed_from) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, datetime.fromtimestamp(now).strftime("%Y-%m-%d"), llm_model, prompt_tokens, completion_tokens, latency, cost,
+                 paper_id, stage, route_id, routed_from),
+            )
+        return cost
+
+    def total_cost(self, paper_id=None):
+        """
+        累计费用，可按论文过滤
+        """
+        sql = "SELECT COALESCE(SUM(cost), 0) FROM usage"
+        params = ()
+        if paper_id is not None:
+            sql += " WHERE paper_id = ?"
+            params = (paper_id,)
+        with self._lock:
+            total = self._connect().execute(sql, params).fetchone()[0]
+        return round(total, 3)
+
+    def summary(self, group_by="stage", since=None):
+        """
+        按论文（paper）、阶段（stage）、日期（day）或模型（model）聚合调用次数、token数、耗时和费用
+        since为"%Y-%m-%d"格式的起始日期
+        """
+        column = self.group_columns[group_by]
+        sql = (
+            f"SELECT {column}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), AVG(latency), SUM(cost) FROM usage"
+        )
+        params = ()
+        if since is not None:
+            sql += " WHERE day >= ?"
+            params = (since,)
+        sql += f" GROUP BY {column} ORDER BY {column}"
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [
+            {group_by: key, "calls": calls, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+             "avg_latency": round(avg_latency, 3), "cost": round(cost, 4)}
+            for key, calls, prompt_tokens, completion_tokens, avg_latency, cost in rows
+        ]
+
+    def routing_savings(self, since=None):
+        """
+        统计模型路由节省的费用和耗时
+        每次路由请求的节省 = 若直接使用默认模型的估计值 - 实际所有尝试（含升级前失败的尝试）的总和
+        默认模型的耗时按其历史每个completion token的平均耗时估计
+        """
+        sql = "SELECT route_id, routed_from, model, prompt_tokens, completion_tokens, latency, cost FROM usage WHERE route_id IS NOT NULL"
+        params = ()
+        if since is not None:
+            sql += " AND day >= ?"
+            params = (since,)
+        sql += " ORDER BY id"
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(sql, params).fetchall()
+            dt_latency_per_token = dict(conn.execute(
+                "SELECT model, SUM(latency) / SUM(completion_tokens) FROM usage WHERE completion_tokens > 0 GROUP BY model"
+            ).fetchall())
+
+        dt_route = {}
+        for row in rows:
+            dt_route.setdefault(row[0], []).append(row)
+        saved_cost = 0.0
+        saved_latency = 0.0
+        escalated = 0
+        for route_rows in dt_route.values():
+            _, routed_from, model, prompt_tokens, completion_tokens, _, _ = route_rows[-1]
+            if len(route_rows) > 1:
+                escalated += 1
+            saved_cost += calc_fee(prompt_tokens, completion_tokens, routed_from) - sum([row[6] for row in route_rows])
+            if routed_from in dt_latency_per_token:
+                baseline_latency = completion_tokens * dt_latency_per_token[routed_from]
+                saved_latency += baseline_latency - sum([row[5] for row in route_rows])
+        return {"routed_requests": len(dt_route), "escalated_requests": escalated, "saved_cost": round(saved_cost, 4),
+                "saved_latency": round(saved_latency, 3)}
+
+
+usage_ledger = UsageLedger(db_path=os.path.join(record_dir, "usage.sqlite"))
+
+
+class EmbeddingStore:
+    """
+    embedding的磁盘缓存：向量存放在内存映射的float32矩阵中，文本hash到行号的索引存放在SQLite中
+    行号的分配和矩阵的扩容都在SQLite写事务内完成，因此多个进程可以同时读写
+    """
+
+    def __init__(self, cache_dir="./record/embedding_cache", dim=1536):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.vector_path = os.path.join(cache_dir, "vectors.f32")
+        self.index_path = os.path.join(cache_dir, "index.sqlite")
+        self.min_capacity = 1024
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._matrix = None
+
+    def _connect(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embedding_index (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+            if not os.path.exists(self.vector_path):
+                open(self.vector_path, "wb").close()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+            self._matrix = None
+        return self._conn
+
+    def _get_matrix(self, min_rows=0):
+        """
+        获取向量矩阵的内存映射，文件被其他进程扩容后重新映射
+        """
+        if self._matrix is None or self._matrix.shape[0] < min_rows:
+            rows = os.path.getsize(self.vector_path) // (4 * self.dim)
+            if rows == 0:
+                return None
+            self._matrix = np.memmap(self.vector_path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+        return self._matrix
+
+    def get_many(self, keys):
+        """
+        批量读取向量，返回key到向量的字典，未命中的key不在字典中
+        """
+        if len(keys) == 0:
+            return {}
+        with self._lock:
+            conn = self._connect()
+            dt_row = {}
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                sql = f"SELECT key, row FROM embedding_index WHERE key IN ({','.join(['?'] * len(batch))})"
+                dt_row.update(dict(conn.execute(sql, batch).fetchall()))
+            if len(dt_row) == 0:
+                return {}
+            matrix = self._get_matrix(min_rows=max(dt_row.values()) + 1)
+            return {key: np.array(matrix[row]) for key, row in dt_row.items()}
+
+    def put_many(self, keys, vectors):
+        """
+        批量写入向量，已存在的key会被跳过
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
             try:
-                reply = openai.Embedding.create(input=text, model=embedding_model)
-                tokens_num = reply["usage"]["total_tokens"]
-                embedding = np.array(reply["data"][0]["embedding"])
-                self._record_fee(tokens_num, 0, llm_model=embedding_model)
-                return embedding
+                exist_keys = set()
+                for i in range(0, len(keys), 500):
+                    batch = keys[i : i + 500]
+                    sql = f"SELECT key FROM embedding_index WHERE key IN ({','.join(['?'] * len(batch))})"
+                    exist_keys.update([row[0] for row in conn.execute(sql, batch).fetchall()])
+                ls_index = [i for i, key in enumerate(keys) if key not in exist_keys]
+                if len(ls_index) > 0:
+                    start_row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM embedding_index").fetchone()[0]
+                    end_row = start_row + len(ls_index)
+                    capacity = os.path.getsize(self.vector_path) // (4 * self.dim)
+                    if end_row > capacity:
+                        # 按倍数扩容，减少重新映射的次数
+                        new_capacity = max(self.min_capacity, capacity * 2, end_row)
+                        self._matrix = None
+                        with open(self.vector_path, "r+b") as f:
+                            f.truncate(new_capacity * 4 * self.dim)
+                    matrix = self._get_matrix(min_rows=end_row)
+                    matrix[start_row:end_row] = vectors[ls_index]
+                    matrix.flush()
+                    conn.executemany(
+                        "INSERT INTO embedding_index (key, row) VALUES (?, ?)",
+                        [(keys[i], start_row + j) for j, i in enumerate(ls_index)],
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return
+
+
+embedding_store = EmbeddingStore(cache_dir=os.path.join(record_dir, "embedding_cache"))
+
+
+class SingleFlight:
+    """
+    合并相同的在途请求：同一key同时只有一个上游调用，其余调用方等待并共享它的结果
+    结果通过concurrent.futures.Future传递，因此不同线程、不同事件循环中的协程都可以等待
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.leader_calls = 0
+        self.coalesced_calls = 0
+
+    def _join(self, key):
+        """
+        返回(future, 是否为发起上游调用的leader)
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced_calls += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._inflight[key] = future
+            self.leader_calls += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return
+
+    async def async_do(self, key, coro_func):
+        """
+        执行coro_func()，若已有相同key的调用在途则等待其结果
+        leader被取消、被所在的取消范围停止（LLMCancelled）或用完自己的重试预算（RetryBudgetExhausted）时，
+        这些只属于leader调用方的异常不会传给等待方，等待方会重新竞争成为leader
+        """
+        while True:
+            future, is_leader = self._join(key)
+            if not is_leader:
+                # shield：等待方被取消时不能取消共享的future
+                result = await asyncio.shield(asyncio.wrap_future(future))
+                if result is _leader_cancelled:
+                    continue
+                return result
+            try:
+                result = await coro_func()
+            except (asyncio.CancelledError, LLMCancelled, RetryBudgetExhausted):
+                self._finish(key, future, result=_leader_cancelled)
+                raise
             except BaseException as error:
-                time.sleep(5)
-        logging.warning(f"生成embedding失败")
+                self._finish(key, future, error=error)
+                raise
+            self._finish(key, future, result=result)
+            return result
+
+    def do(self, key, func):
+        """
+        async_do的同步版本，供线程直接调用，leader的取消和重试预算耗尽同样不会传给等待方
+        """
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                break
+            result = future.result()
+            if result is not _leader_cancelled:
+                return result
+        try:
+            result = func()
+        except (LLMCancelled, RetryBudgetExhausted):
+            self._finish(key, future, result=_leader_cancelled)
+            raise
+        except BaseException as error:
+            self._finish(key, future, error=error)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def stats(self):
+        """
+        输出发起的上游调用次数和被合并的调用次数
+        """
+        with self._lock:
+            return {"leader_calls": self.leader_calls, "coalesced_calls": self.coalesced_calls, "inflight": len(self._inflight)}
+
+
+_leader_cancelled = object()
+llm_single_flight = SingleFlight()
+
+
+class CircuitOpenError(Exception):
+    """
+    熔断器打开期间拒绝向该endpoint发送请求
+    """
+
+    def __init__(self, endpoint, retry_after):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(f"{endpoint}的熔断器已打开，{retry_after:.1f}s后重试")
+
+
+class CircuitBreaker:
+    """
+    按endpoint区分的熔断器：最近window次请求中失败比例达到error_threshold（且至少min_requests次）时打开，
+    打开期间直接拒绝请求，cooldown秒后进入半开状态放行一个探测请求，探测成功则关闭，失败则重新打开
+    探测请求没有得到结果就结束（被取消、限流等）时回到打开状态并允许立即再次探测；
+    半开状态超过probe_timeout秒仍未得到结果时（探测请求丢失）同样放行新的探测请求
+    只统计超时、连接错误和服务端错误，限流（429）不计入
+    """
+
+    def __init__(self, error_threshold=0.5, window=20, min_requests=10, cooldown=30.0, probe_timeout=300.0):
+        self.error_threshold = error_threshold
+        self.window = window
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        # endpoint -> {"outcomes": 最近请求是否成功, "state", "opened_at", "probe", "probe_at", "open_count", "rejected"}
+        self._endpoints = {}
+
+    def _get(self, endpoint):
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = {
+                "outcomes": [], "state": "closed", "opened_at": 0.0, "probe": None, "probe_at": 0.0, "open_count": 0, "rejected": 0
+            }
+        return self._endpoints[endpoint]
+
+    def before_request(self, endpoint):
+        """
+        请求前调用，熔断器打开时抛出CircuitOpenError
+        当前请求为半开状态的探测请求时返回探测标识，请求结束时（无论结果如何）需要调用finish_probe，否则返回None
+        """
+        with self._lock:
+            item = self._get(endpoint)
+            if item["state"] == "closed":
+                return None
+            now = time.time()
+            retry_after = item["opened_at"] + self.cooldown - now
+            if (item["state"] == "open" and retry_after <= 0) or (item["state"] == "half_open" and now - item["probe_at"] > self.probe_timeout):
+                # 进入半开状态，只放行当前这一个探测请求
+                item["state"] = "half_open"
+                item["probe"] = object()
+                item["probe_at"] = now
+                return item["probe"]
+            item["rejected"] += 1
+            raise CircuitOpenError(endpoint, max(retry_after, 1.0))
+
+    def finish_probe(self, endpoint, probe):
+        """
+        探测请求结束时调用：探测没有通过record得到结果时回到打开状态，下一个请求可以立即重新探测
+        """
+        if probe is None:
+            return
+        with self._lock:
+            item = self._get(endpoint)
+            if item["state"] == "half_open" and item["probe"] is probe:
+                item["state"] = "open"
+                item["opened_at"] = time.time() - self.cooldown
+                item["probe"] = None
+        return
+
+    def record(self, endpoint, success):
+        with self._lock:
+            item = self._get(endpoint)
+            if item["state"] == "half_open":
+                item["probe"] = None
+                if success:
+                    item["state"] = "closed"
+                    item["outcomes"] = []
+                else:
+                    self._open(item)
+                return
+            item["outcomes"] = (item["outcomes"] + [success])[-self.window:]
+            num_errors = item["outcomes"].count(False)
+            if (
+                item["state"] == "closed"
+                and len(item["outcomes"]) >= self.min_requests
+                and num_errors / len(item["outcomes"]) >= self.error_threshold
+            ):
+                self._open(item)
+        return
+
+    def _open(self, item):
+        item["state"] = "open"
+        item["opened_at"] = time.time()
+        item["open_count"] += 1
+        item["outcomes"] = []
+        logging.error(f"熔断器打开，{self.cooldown}s内不再发送请求")
+        return
+
+    def stats(self):
+        """
+        输出各endpoint的熔断状态、最近错误率、打开次数和被拒绝的请求数
+        """
+        with self._lock:
+            return {
+                endpoint: {
+                    "state": item["state"],
+                    "error_rate": round(item["outcomes"].count(False) / len(item["outcomes"]), 3) if item["outcomes"] else 0.0,
+                    "open_count": item["open_count"],
+                    "rejected": item["rejected"],
+                }
+                for endpoint, item in self._endpoints.items()
+            }
+
+
+llm_circuit_breaker = CircuitBreaker()
+
+
+class RequestHedger:
+    """
+    对冲请求：请求在该模型历史延迟的p95时间内还没有返回时，再发送一个相同的请求，先返回的结果胜出，另一个被取消
+    对冲请求数占总请求数的比例不超过max_extra_ratio；历史延迟样本少于min_samples时不对冲
+    """
+
+    def __init__(self, enabled=False, quantile=0.95, max_extra_ratio=0.1, min_samples=20, history_size=500):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.history_size = history_size
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record_latency(self, llm_model, latency):
+        with self._lock:
+            self._latencies[llm_model] = (self._latencies.get(llm_model, []) + [latency])[-self.history_size:]
+        return
+
+    def hedge_delay(self, llm_model):
+        """
+        返回该模型的对冲等待时间（历史延迟的分位数），样本不足时返回None
+        """
+        with self._lock:
+            latencies = self._latencies.get(llm_model, [])
+            if len(latencies) < self.min_samples:
+                return None
+            return float(np.quantile(latencies, self.quantile))
+
+    def _try_hedge(self):
+        with self._lock:
+            if self.hedged + 1 > self.max_extra_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    async def run(self, llm_model, request_func):
+        """
+        执行request_func()（返回一次请求的协程），必要时以request_func(hedge=True)发送对冲请求，返回先成功的结果
+        """
+        with self._lock:
+            self.requests += 1
+        primary = asyncio.ensure_future(request_func())
+        pending = {primary}
+        try:
+            delay = self.hedge_delay(llm_model) if self.enabled else None
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done and self._try_hedge():
+                    pending.add(asyncio.ensure_future(request_func(hedge=True)))
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                ls_success = [task for task in done if task.exception() is None]
+                if ls_success:
+                    if ls_success[0] is not primary:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return ls_success[0].result()
+                # 一个请求失败时等待另一个，都失败时抛出异常
+                if not pending:
+                    return done.pop().result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        """
+        输出对冲请求的次数、胜出次数、额外请求比例和各模型当前的对冲等待时间
+        """
+        with self._lock:
+            models = list(self._latencies.keys())
+            stats = {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "extra_ratio": round(self.hedged / self.requests, 4) if self.requests else 0.0,
+            }
+        stats["hedge_delay"] = {llm_model: self.hedge_delay(llm_model) for llm_model in models}
+        return stats
+
+
+llm_hedger = RequestHedger()
+
+
+def set_llm_hedging(enabled=True, quantile=None, max_extra_ratio=None):
+    """
+    开启（或关闭）对冲请求，并设置触发对冲的延迟分位数和额外请求比例上限
+    """
+    llm_hedger.enabled = enabled
+    if quantile is not None:
+        llm_hedger.quantile = quantile
+    if max_extra_ratio is not None:
+        llm_hedger.max_extra_ratio = max_extra_ratio
+    return
+
+
+class _ConcurrencySlot:
+    """
+    一个在途请求占用的并发名额，请求结束前通过record记录结果（success / rate_limited / timeout）和延迟
+    """
+
+    def __init__(self, llm_model, saturated):
+        self.llm_model = llm_model
+        self.start_time = time.time()
+        # 获得名额时并发是否已经用满，只有用满时的成功才说明上限可以继续提高
+        self.saturated = saturated
+        self.outcome = None
+        self.latency = None
+
+    def record(self, outcome, latency=None):
+        self.outcome = outcome
+        self.latency = latency
+        return
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    按AIMD自适应调整大模型请求的并发上限，进程内所有阶段（结构抽取、分析、评分、改写）共用
+    并发用满时每次成功请求把上限提高1/limit（约每轮提高1）；出现429或超时时上限乘以backoff，
+    近期延迟（快速EWMA）超过长期延迟（慢速EWMA）的latency_tolerance倍时上限乘以latency_backoff
+    同一批请求引起的多次拥塞信号只降低一次：在上一次降低之前发出的请求不再触发降低
+    上限的每次变化记录在history中，用于调参
+    """
+
+    def __init__(self, limit=8, min_limit=1, max_limit=64, backoff=0.5, latency_backoff=0.9, latency_tolerance=2.0, min_samples=10,
+                 history_size=1000):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_backoff = latency_backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        self.history_size = history_size
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # 等待名额的请求（先到先得）：{"loop", "future", "granted"}
+        self._waiters = []
+        self._last_decrease = 0.0
+        # llm_model -> {"samples", "short", "long"}：延迟样本数、快速和慢速EWMA
+        self._latencies = {}
+        self.counts = {"success": 0, "rate_limited": 0, "timeout": 0, "latency": 0}
+        self.history = [(time.time(), int(self.limit), "init")]
+
+    def configure(self, max_limit=None, min_limit=None, limit=None):
+        with self._lock:
+            if max_limit is not None:
+                self.max_limit = max_limit
+            if min_limit is not None:
+                self.min_limit = min_limit
+            self._set_limit(self.limit if limit is None else limit, "configure")
+        self._wake()
+        return
+
+    def _set_limit(self, limit, reason):
+        old_limit = int(self.limit)
+        self.limit = float(min(max(limit, self.min_limit), self.max_limit))
+        if int(self.limit) != old_limit or reason == "configure":
+            self.history = (self.history + [(time.time(), int(self.limit), reason)])[-self.history_size:]
+        return
+
+    def _wake(self):
+        """
+        在名额允许时按顺序唤醒等待的请求
+        """
+        with self._lock:
+            while self._waiters and self._in_flight < int(self.limit):
+                waiter = self._waiters.pop(0)
+                waiter["granted"] = True
+                self._in_flight += 1
+                waiter["loop"].call_soon_threadsafe(_set_future_result, waiter["future"], self._in_flight >= int(self.limit))
+        return
+
+    async def _acquire(self):
+        with self._lock:
+            if not self._waiters and self._in_flight < int(self.limit):
+                self._in_flight += 1
+                return self._in_flight >= int(self.limit)
+            waiter = {"loop": asyncio.get_running_loop(), "future": asyncio.get_running_loop().create_future(), "granted": False}
+            self._waiters.append(waiter)
+        try:
+            return await waiter["future"]
+        except BaseException:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter = None
+            # 名额已经分配给这个被取消的请求，归还名额
+            if waiter is not None:
+                self._release(None)
+            raise
+
+    def _release(self, slot):
+        with self._lock:
+            self._in_flight -= 1
+            if slot is not None and slot.outcome is not None:
+                self._update(slot)
+        self._wake()
+        return
+
+    def _update(self, slot):
+        self.counts[slot.outcome] += 1
+        if slot.outcome == "success":
+            if slot.latency is not None and self._latency_congested(slot.llm_model, slot.latency):
+                self.counts["latency"] += 1
+                self._decrease(slot, self.latency_backoff, "latency")
+            elif slot.saturated:
+                self._set_limit(self.limit + 1 / self.limit, "success")
+        else:
+            self._decrease(slot, self.backoff, slot.outcome)
+        return
 
-        # 生成全是nan的embedding
-        embedding = np.full(1536, np.nan)
-        # embedding = np.random.randn(1536)
-        # embedding = embedding / np.linalg.norm(embedding)
+    def _latency_congested(self, llm_model, latency):
+        item = self._latencies.setdefault(llm_model, {"samples": 0, "short": latency, "long": latency})
+        item["samples"] += 1
+        item["short"] = 0.7 * item["short"] + 0.3 * latency
+        item["long"] = 0.95 * item["long"] + 0.05 * latency
+        return item["samples"] >= self.min_samples and item["short"] > self.latency_tolerance * item["long"]
 
-        return embedding
+    def _decrease(self, slot, factor, reason):
+        if slot.start_time < self._last_decrease:
+            return
+        self._last_decrease = time.time()
+        self._set_limit(self.limit * factor, reason)
+        return
 
-    def fee(self):
+    @asynccontextmanager
+    async def slot(self, llm_model):
         """
-        输出当前累计费用
+        占用一个并发名额，名额不足时排队等待；退出时根据slot.record记录的结果调整上限
         """
+        saturated = await self._acquire()
+        slot = _ConcurrencySlot(llm_model, saturated)
         try:
-            info = load_json(self.fee_path)
-        except:
-            info = {"fee": 0.0}
-        return info["fee"]
+            yield slot
+        finally:
+            self._release(slot)
+
+    def stats(self, history_num=50):
+        """
+        输出当前的并发上限、在途和排队的请求数、各类信号的次数、各模型的延迟EWMA和最近history_num次上限变化
+        """
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                "counts": dict(self.counts),
+                "latency": {
+                    llm_model: {"short": round(item["short"], 3), "long": round(item["long"], 3)}
+                    for llm_model, item in self._latencies.items()
+                },
+                "history": list(self.history[-history_num:]),
+            }
+
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+    return
+
+
+llm_concurrency = AdaptiveConcurrencyLimiter()
+
+
+def get_llm_parallelism(task_num):
+    """
+    并行阶段同时派发的任务数量：不超过并发上限的最大值，实际在途的请求数由llm_concurrency自适应控制
+    """
+    return max(1, min(task_num, llm_concurrency.max_limit))
+
+
+def _concurrency_signal(error):
+    """
+    将请求异常转换为并发控制的信号：429为rate_limited，超时为timeout，其余异常不影响并发上限
+    """
+    if isinstance(error, openai.error.RateLimitError):
+        return "rate_limited"
+    if isinstance(error, (asyncio.TimeoutError, openai.error.Timeout)):
+        return "timeout"
+    return None
+
+
+def _is_endpoint_failure(error):
+    """
+    判断异常是否说明endpoint本身不可用（超时、连接错误、服务端错误），用于熔断器统计
+    """
+    if isinstance(error, (asyncio.TimeoutError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+                          openai.error.APIError)):
+        return True
+    http_status = getattr(error, "http_status", None)
+    return http_status is not None and http_status >= 500
+
+
+def llm_metrics():
+    """
+    汇总当前进程中大模型调用的各项指标：缓存、single-flight、对冲请求、熔断器、自适应并发和JSON修复
+    """
+    return {
+        "cache": llm_cache.stats(),
+        "single_flight": llm_single_flight.stats(),
+        "hedging": llm_hedger.stats(),
+        "circuit_breaker": llm_circuit_breaker.stats(),
+        "concurrency": llm_concurrency.stats(),
+        "json_repair": repair_stats(),
+    }
+
+
+def _use_llm_cache(use_cache, temperature):
+    """
+    use_cache为None时仅缓存温度为0的确定性请求，为False时绕过缓存
+    """
+    if not llm_cache_enabled or use_cache is False:
+        return False
+    if use_cache is None:
+        return temperature == 0
+    return True
+
+
+class GPT:
+    def __init__(self, memory_max_tokens=None, memory_strategy=None):
+        """
+        memory_max_tokens为对话历史（含新请求）的token预算，默认None表示不限制（不裁剪对话历史），需要时由调用方设置
+        memory_strategy为超出预算时的裁剪策略，默认丢弃最早的对话，"summarize"表示将较早的对话压缩成摘要
+        """
+        self.max_try_num = 3
+        self.token_fee_dict = token_fee_dict
+        self.llm_system_content = "Assuming you are an expert in English paper polishing."
+        if memory_strategy == "summarize":
+            memory_strategy = SummarizeStrategy(self._async_summarize)
+        self.memory = ConversationMemory(self.llm_system_content, max_tokens=memory_max_tokens, strategy=memory_strategy)
+
+    def _record_fee(self, prompt_tokens, completion_tokens, llm_model, latency=0.0):
+        """
+        记录大模型费用
+        """
+        usage_ledger.record(llm_model, prompt_tokens, completion_tokens, latency)
+        return
+
+    async def _async_request(self, messages, llm_model, temperature, response_type, max_tokens=None, use_cache=None, refresh_cache=False):
+        """
+        使用大模型生成回复（异步）
+        """
+        return await async_chat_request(
+            messages, llm_model=llm_model, temperature=temperature, response_type=response_type, max_tokens=max_tokens,
+            max_try=self.max_try_num, use_cache=use_cache, refresh_cache=refresh_cache
+        )
+
+    def _request(self, messages, llm_model, temperature, response_type, max_tokens=None, use_cache=None, refresh_cache=False):
+        """
+        使用大模型生成回复
+        """
+        return run_coroutine_sync(
+            self._async_request(
+                messages, llm_model=llm_model, temperature=temperature, response_type=response_type, max_tokens=max_tokens,
+                use_cache=use_cache, refresh_cache=refresh_cache
+            )
+        )
+
+    def embed_many(self, texts, batch_size=2048):
+        """
+        批量计算文本的嵌入，返回形状为(len(texts), 1536)的连续float32矩阵
+        相同文本只请求一次，已缓存的文本直接从embedding_store读取，其余文本按batch_size分批请求
+        请求失败的文本对应全是nan的向量（不写入缓存）
+        """
+        embedding_model = "text-embedding-ada-002"
+        texts = [info_to_text(text) for text in texts]
+        keys = [hashcode(f"{embedding_model}\n{text}") for text in texts]
+
+        # 去重后查询缓存
+        dt_text = dict(zip(keys, texts))
+        dt_embedding = embedding_store.get_many(list(dt_text.keys()))
+        ls_missing_key = [key for key in dt_text if key not in dt_embedding]
+
+        for i in range(0, len(ls_missing_key), batch_size):
+            batch_key = ls_missing_key[i : i + batch_size]
+            batch_text = [dt_text[key] for key in batch_key]
+            estimated_tokens = sum([count_tokens(text) for text in batch_text])
+            for try_count in range(self.max_try_num):
+                try:
+                    rate_limiter.acquire(embedding_model, estimated_tokens)
+                    start_time = time.time()
+                    reply = openai.Embedding.create(input=batch_text, model=embedding_model, request_timeout=(llm_connect_timeout, llm_read_timeout))
+                    latency = time.time() - start_time
+                    tokens_num = reply["usage"]["total_tokens"]
+                    self._record_fee(tokens_num, 0, llm_model=embedding_model, latency=latency)
+                    batch_embedding = np.zeros((len(batch_key), embedding_store.dim), dtype=np.float32)
+                    for item in reply["data"]:
+                        batch_embedding[item["index"]] = item["embedding"]
+                    embedding_store.put_many(batch_key, batch_embedding)
+                    dt_embedding.update(zip(batch_key, batch_embedding))
+                    break
+                except BaseException as error:
+                    logging.error(f"生成embedding失败: \n{error}")
+                    time.sleep(backoff_delay(try_count, base=2.0))
+
+        # 生成失败的文本对应全是nan的embedding
+        embeddings = np.full((len(texts), embedding_store.dim), np.nan, dtype=np.float32)
+        for i, key in enumerate(keys):
+            if key in dt_embedding:
+                embeddings[i] = dt_embedding[key]
+        return embeddings
+
+    def embedding(self, text):
+        """
+        使用大模型计算文本的嵌入
+        """
+        return self.embed_many([text])[0]
+
+    def fee(self, paper_id=None):
+        """
+        输出当前累计费用，可按论文过滤；更细的聚合见usage_ledger.summary
+        """
+        return usage_ledger.total_cost(paper_id=paper_id)
+
+    @property
+    def conversation(self):
+        return self.memory.messages
+
+    @conversation.setter
+    def conversation(self, conversation):
+        self.memory.reset(conversation)
 
     def reset_conversation(self, conversation=None):
         """
@@ -331,37 +1773,48 @@ class GPT:
         """
         if conversation is None:
             conversation = [{"role": "system", "content": self.llm_system_content}]
-        self.conversation = conversation
+        self.memory.reset(conversation)
         return
 
     def replace_content(self, old_content, new_content):
         """
         将对话历史中所有包含old_content的内容替换为new_content
         """
-        for item in self.conversation:
-            if old_content in item["content"]:
-                item["content"] = item["content"].replace(old_content, new_content)
+        self.memory.replace_content(old_content, new_content)
         return
 
     def conversation_tokens_num(self):
         """
-        计算对话历史中的token数量
+        计算对话历史中的token数量（增量维护）
         """
-        text = "\n".join([item["content"] for item in self.conversation])
-        num_tokens = calc_tokens_num_from_text(text)
-        return num_tokens
+        return self.memory.tokens_num
 
-    def chat(self, request, llm_model='gpt-4-1106-preview', temperature=0.4, response_type="text", max_tokens=None, parse_func=None):
+    async def _async_summarize(self, previous_summary, messages):
+        """
+        将被裁剪的对话压缩成摘要，供SummarizeStrategy使用
         """
-        与大模型对话
+        request = "Summarize the following conversation in a concise paragraph, keeping all facts, decisions and requirements " \
+                  "that later turns may rely on.\n\n"
+        if previous_summary:
+            request += f"Summary of the conversation before it:\n{previous_summary}\n\n"
+        request += "\n\n".join([f"{item['role']}: {item['content']}" for item in messages])
+        return await self._async_request(
+            _build_messages(request, self.llm_system_content), llm_model="gpt-3.5-turbo-1106", temperature=0.0, response_type="text"
+        )
+
+    async def async_chat(self, request, llm_model='gpt-4-1106-preview', temperature=0.4, response_type="text", max_tokens=None, parse_func=None):
+        """
+        与大模型对话（异步）
         若回复成功，则返回解析后的reply，并将request和reply添加到对话历史中
         若回复失败，则返回None，不将request和reply添加到对话历史中
         """
         # logging.info(f"开始请求 \n{request}")
 
         request = info_to_text(request)
+        # 超出token预算时先裁剪对话历史，保证每轮请求的长度不随对话轮数增长
+        await self.memory.prune(reserve_tokens=count_tokens(request) + tokens_per_message + (max_tokens or 0))
         messages = self.conversation + [{"role": "user", "content": request}]
-        reply = self._request(
+        reply = await self._async_request(
             messages, llm_model=llm_model, temperature=temperature, response_type=response_type, max_tokens=max_tokens
         )
 
@@ -375,17 +1828,37 @@ class GPT:
             parse_reply = reply
 
         # 若对话完成，则将记录添加到对话历史中，注意这里记录的是request和原始reply
-        self.conversation.append({"role": "user", "content": request})
-        self.conversation.append({"role": "assistant", "content": reply})
+        self.memory.append({"role": "user", "content": request})
+        self.memory.append({"role": "assistant", "content": reply})
         # logging.info(f"请求成功 \n{reply}")
 
         # 返回解析后的reply
         return parse_reply
 
-    def robust_chat(self, request, llm_model, temperatures: list, response_type="text", max_tokens=None, parse_func=None):
+    def chat(self, request, llm_model='gpt-4-1106-preview', temperature=0.4, response_type="text", max_tokens=None, parse_func=None):
+        """
+        与大模型对话，async_chat的同步封装
+        """
+        return run_coroutine_sync(
+            self.async_chat(
+                request, llm_model=llm_model, temperature=temperature, response_type=response_type, max_tokens=max_tokens, parse_func=parse_func
+            )
+        )
+
+    def robust_chat(self, request, llm_model, temperatures: list, response_type="text", max_tokens=None, parse_func=None, sequential=True,
+                    parallel_num=3, max_cost=None):
         """
         鲁棒请求，给定一组温度，当请求失败时，自动改变温度，重新请求
+        默认逐个温度请求；sequential=False时并发请求前parallel_num个温度（费用最多为parallel_num倍，可用max_cost限制），
+        第一个通过parse_func的回复胜出
         """
+        if not sequential:
+            return run_coroutine_sync(
+                self.async_robust_chat(
+                    request, llm_model, temperatures, response_type=response_type, max_tokens=max_tokens, parse_func=parse_func,
+                    parallel_num=parallel_num, max_cost=max_cost
+                )
+            )
 
         for temperature in temperatures:
             try:
@@ -400,53 +1873,406 @@ class GPT:
                 return reply
             except AssertionError as error:
                 logging.error(f"解析失败：{error}")
+            except (RetryBudgetExhausted, LLMCancelled):
+                raise
             except:
                 logging.error(f"chat报错：\n{traceback.format_exc()}")
                 time.sleep(3)
         return None
 
+    async def async_robust_chat(self, request, llm_model, temperatures: list, response_type="text", max_tokens=None, parse_func=None,
+                                parallel_num=3, max_cost=None):
+        """
+        并发的鲁棒请求：同时请求前parallel_num个温度，某个请求失败（请求出错或parse_func解析失败）时补上下一个温度
+        第一个解析成功的回复胜出，其余在途请求被取消，胜出的request和reply添加到对话历史中；全部失败时返回None
+        max_cost为同时在途请求的估计费用上限（美元），据此减少并发数量，但至少保留一个请求
+        """
+        request = info_to_text(request)
+        await self.memory.prune(reserve_tokens=count_tokens(request) + tokens_per_message + (max_tokens or 0))
+        messages = self.conversation + [{"role": "user", "content": request}]
+
+        if max_cost is not None:
+            prompt_tokens = count_messages_tokens(messages)
+            estimated_cost = calc_fee(prompt_tokens, rate_limiter.estimate_tokens(messages, max_tokens) - prompt_tokens, llm_model)
+            if estimated_cost > 0:
+                parallel_num = min(parallel_num, max(1, int(max_cost // estimated_cost)))
+
+        async def attempt(temperature):
+            reply = await self._async_request(
+                messages, llm_model=llm_model, temperature=temperature, response_type=response_type, max_tokens=max_tokens
+            )
+            if reply is None:
+                raise ValueError(f"temperature={temperature}的请求失败")
+            return reply, parse_func(reply) if parse_func is not None else reply
+
+        ls_temperature = list(temperatures)
+        pending = set()
+        try:
+            while ls_temperature or pending:
+                while ls_temperature and len(pending) < parallel_num:
+                    pending.add(asyncio.ensure_future(attempt(ls_temperature.pop(0))))
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        reply, parse_reply = task.result()
+                        self.memory.append({"role": "user", "content": request})
+                        self.memory.append({"role": "assistant", "content": reply})
+                        return parse_reply
+                    if isinstance(error, (RetryBudgetExhausted, LLMCancelled)):
+                        raise error
+                    if isinstance(error, AssertionError):
+                        logging.error(f"解析失败：{error}")
+                    else:
+                        logging.error(f"chat报错：\n{''.join(traceback.format_exception(error))}")
+        finally:
+            for task in pending:
+                task.cancel()
+        return None
+
 
-def llm_request(request, system_content=None, temperature=0.0, max_tokens=None, llm_model="gpt-4-1106-preview", response_type="text"):
+def _build_messages(request, system_content=None):
     messages = [{'role': 'user', 'content': request}]
     if not system_content:
         system_content = "Assuming you are an expert in English paper polishing."
     messages = [{'role': 'system', 'content': system_content}] + messages
-    max_try = 10
-    cur_try = 0
-    while cur_try < max_try:
+    return messages
+
+
+def _record_completion(llm_model, estimated_tokens, prompt_tokens, completion_tokens, latency, cache_key, reply):
+    """
+    请求成功后的记录：用实际token数修正限流的预扣额度、追加用量记录，cache_key不为None时写入缓存
+    """
+    rate_limiter.settle(llm_model, estimated_tokens, prompt_tokens + completion_tokens)
+    usage_ledger.record(llm_model, prompt_tokens, completion_tokens, latency)
+    if cache_key is not None:
+        llm_cache.set(cache_key, reply)
+    return
+
+
+async def _async_chat_completion(messages, llm_model, temperature, response_type, max_tokens, max_try, cache_key=None):
+    """
+    向上游发送请求：发送前检查上下文窗口，请求经过限流和并发控制，失败时带抖动退避重试，成功后记录用量并写入缓存
+    """
+    # 超出上下文窗口的prompt在发送前直接拒绝
+    check_prompt_budget(messages, llm_model, max_tokens)
+    estimated_tokens = rate_limiter.estimate_tokens(messages, max_tokens)
+    endpoint = openai.api_base
+
+    async def send():
+        start_time = time.time()
+        completion = await openai.ChatCompletion.acreate(
+            model=llm_model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=messages,
+            response_format={"type": response_type},
+            request_timeout=(llm_connect_timeout, llm_read_timeout),
+        )
+        return completion, time.time() - start_time
+
+    async def request_once(hedge=False):
+        if not hedge:
+            return await send()
+        # 对冲请求同样要经过限流，并占用一个并发名额
+        await rate_limiter.async_acquire(llm_model, estimated_tokens)
+        async with llm_concurrency.slot(llm_model) as slot:
+            try:
+                completion, latency = await send()
+            except Exception as error:
+                slot.record(_concurrency_signal(error))
+                raise
+            slot.record("success", latency)
+            return completion, latency
+
+    for try_count in range(max_try):
+        check_cancelled()
+        if try_count > 0:
+            consume_retry()
         try:
-            completion = openai.ChatCompletion.create(
-                model=llm_model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                messages=messages,
-                response_format={"type": response_type}
-            )
+            probe = llm_circuit_breaker.before_request(endpoint)
+            try:
+                await _await_cancellable(rate_limiter.async_acquire(llm_model, estimated_tokens))
+                async with llm_concurrency.slot(llm_model) as slot:
+                    try:
+                        completion, latency = await _await_cancellable(
+                            llm_hedger.run(llm_model, request_once), timeout=llm_connect_timeout + llm_read_timeout
+                        )
+                    except Exception as error:
+                        # 限流和其他4xx错误不计入熔断统计，半开状态的探测请求由finish_probe释放
+                        if _is_endpoint_failure(error):
+                            llm_circuit_breaker.record(endpoint, False)
+                        slot.record(_concurrency_signal(error))
+                        raise
+                    slot.record("success", latency)
+                llm_circuit_breaker.record(endpoint, True)
+            finally:
+                llm_circuit_breaker.finish_probe(endpoint, probe)
+            llm_hedger.record_latency(llm_model, latency)
             reply = completion.choices[0]['message']['content']
+            token_num = completion.usage.to_dict()
+            # 达到max_tokens被截断的回复不写入缓存，否则之后的请求会一直拿到同一个不完整的回复
+            await _run_blocking(
+                _record_completion, llm_model, estimated_tokens, token_num["prompt_tokens"], token_num["completion_tokens"], latency,
+                cache_key if completion.choices[0].get("finish_reason") != "length" else None, reply
+            )
             return reply
-        except KeyboardInterrupt:
-            return
+        except (asyncio.CancelledError, LLMCancelled):
+            raise
+        except CircuitOpenError as error:
+            logging.error(str(error))
+            await _await_cancellable(asyncio.sleep(retry_delay(error.retry_after)))
+        except (asyncio.TimeoutError, openai.error.Timeout):
+            logging.error(f"请求超时: {llm_model}")
+            await _await_cancellable(asyncio.sleep(retry_delay(backoff_delay(try_count, base=1.0))))
         except openai.error.APIConnectionError:
-            print("APIConnectionError")
-            time.sleep(3)
-            cur_try += 1
+            logging.error("APIConnectionError")
+            await _await_cancellable(asyncio.sleep(retry_delay(backoff_delay(try_count, base=1.0))))
         except openai.error.RateLimitError:
+            logging.error(f"RateLimitError: {llm_model}")
+            await _await_cancellable(asyncio.sleep(retry_delay(backoff_delay(try_count, base=4.0))))
+        except Exception:
+            logging.error(f"大模型调用失败: \n{traceback.format_exc()}")
+            await _await_cancellable(asyncio.sleep(retry_delay(backoff_delay(try_count, base=1.0))))
+    return None
+
+
+async def async_chat_request(messages, llm_model="gpt-4-1106-preview", temperature=0.0, response_type="text", max_tokens=None, max_try=10,
+                             use_cache=None, refresh_cache=False):
+    """
+    异步请求大模型的公共入口：先查缓存，未命中时通过single-flight合并相同的在途请求
+    温度为0的请求默认读写缓存；use_cache=False绕过缓存，refresh_cache=True跳过读取但会用新回复覆盖缓存（用于解析失败后的重试）
+    """
+    request_key = LLMCache.make_key(llm_model, messages, temperature, response_type, max_tokens)
+    cache_key = None
+    if _use_llm_cache(use_cache, temperature):
+        cache_key = request_key
+        reply = None if refresh_cache else await _run_blocking(llm_cache.get, cache_key)
+        if reply is not None:
+            return reply
+
+    if refresh_cache:
+        request_key += ":refresh"
+    return await llm_single_flight.async_do(
+        request_key,
+        lambda: _async_chat_completion(messages, llm_model, temperature, response_type, max_tokens, max_try, cache_key),
+    )
+
+
+async def async_llm_request(request, system_content=None, temperature=0.0, max_tokens=None, llm_model="gpt-4-1106-preview", response_type="text",
+                            use_cache=None, refresh_cache=False):
+    """
+    异步请求大模型，在途请求数由进程内共用的自适应并发上限（llm_concurrency）控制，遇到429或超时时自动降低
+    """
+    messages = _build_messages(request, system_content)
+    return await async_chat_request(
+        messages, llm_model=llm_model, temperature=temperature, response_type=response_type, max_tokens=max_tokens, max_try=10,
+        use_cache=use_cache, refresh_cache=refresh_cache
+    )
+
+
+async def async_llm_request_many(requests, **kwargs):
+    """
+    并发请求一组prompt，返回顺序与requests一致
+    """
+    return await asyncio.gather(*[async_llm_request(request, **kwargs) for request in requests])
+
+
+async def async_llm_request_stream(request, system_content=None, temperature=0.0, max_tokens=None, llm_model="gpt-4-1106-preview",
+                                   response_type="text", use_cache=None):
+    """
+    流式请求大模型，逐个yield回复的增量文本
+    命中缓存时一次性yield完整回复；已经输出部分内容后出错不再重试（避免重复输出），直接抛出异常；重试次数用完时抛出最后一次的异常
+    调用方提前结束、取消或超时时关闭上游的流式响应（释放HTTP连接）
+    """
+    messages = _build_messages(request, system_content)
+    cache_key = None
+    if _use_llm_cache(use_cache, temperature):
+        cache_key = LLMCache.make_key(llm_model, messages, temperature, response_type, max_tokens)
+        reply = await _run_blocking(llm_cache.get, cache_key)
+        if reply is not None:
+            yield reply
+            return
+    prompt_tokens = check_prompt_budget(messages, llm_model, max_tokens)
+    estimated_tokens = rate_limiter.estimate_tokens(messages, max_tokens)
+    max_try = 10
+    last_error = None
+    for try_count in range(max_try):
+        check_cancelled()
+        if try_count > 0:
+            consume_retry()
+        ls_delta = []
+        finish_reason = None
+        response = None
+        try:
+            probe = llm_circuit_breaker.before_request(openai.api_base)
+            try:
+                await _await_cancellable(rate_limiter.async_acquire(llm_model, estimated_tokens))
+                async with llm_concurrency.slot(llm_model) as slot:
+                    start_time = time.time()
+                    try:
+                        # 流式回复的总时长不设上限，只限制相邻两个片段之间的间隔
+                        response = await _await_cancellable(
+                            openai.ChatCompletion.acreate(
+                                model=llm_model,
+                                max_tokens=max_tokens,
+                                temperature=temperature,
+                                messages=messages,
+                                response_format={"type": response_type},
+                                stream=True,
+                                request_timeout=(llm_connect_timeout, None),
+                            ),
+                            timeout=llm_connect_timeout + llm_read_timeout,
+                        )
+                        while True:
+                            try:
+                                chunk = await _await_cancellable(response.__anext__(), timeout=llm_read_timeout)
+                            except StopAsyncIteration:
+                                break
+                            finish_reason = chunk.choices[0].get("finish_reason") or finish_reason
+                            delta = chunk.choices[0]["delta"].get("content")
+                            if delta:
+                                ls_delta.append(delta)
+                                yield delta
+                    except Exception as error:
+                        # 限流和其他4xx错误不计入熔断统计，半开状态的探测请求由finish_probe释放
+                        if _is_endpoint_failure(error):
+                            llm_circuit_breaker.record(openai.api_base, False)
+                        slot.record(_concurrency_signal(error))
+                        raise
+                    finally:
+                        if response is not None and hasattr(response, "aclose"):
+                            await response.aclose()
+                    # 流式请求的总时长取决于回复长度，不作为延迟信号
+                    slot.record("success")
+                    latency = time.time() - start_time
+                llm_circuit_breaker.record(openai.api_base, True)
+            finally:
+                llm_circuit_breaker.finish_probe(openai.api_base, probe)
+            reply = "".join(ls_delta)
+            # 流式回复不返回usage，completion的token数按回复文本统计
+            completion_tokens = count_tokens(reply)
+            await _run_blocking(
+                _record_completion, llm_model, estimated_tokens, prompt_tokens, completion_tokens, latency,
+                cache_key if finish_reason != "length" else None, reply
+            )
+            return
+        except (asyncio.CancelledError, LLMCancelled):
+            raise
+        except CircuitOpenError as error:
+            last_error = error
+            logging.error(str(error))
+            await _await_cancellable(asyncio.sleep(retry_delay(error.retry_after)))
+        except openai.error.RateLimitError as error:
+            if ls_delta:
+                raise
+            last_error = error
             traceback.print_exc()
-            time.sleep(60)
-            cur_try += 1
-        except:
+            await _await_cancellable(asyncio.sleep(retry_delay(backoff_delay(try_count, base=4.0))))
+        except Exception as error:
+            if ls_delta:
+                raise
+            last_error = error
             traceback.print_exc()
-            time.sleep(3)
-            cur_try += 1
-    return None
+            await _await_cancellable(asyncio.sleep(retry_delay(backoff_delay(try_count, base=1.0))))
+    raise last_error
 
 
-if __name__ == '__main__':
-    model = GPT()
-    print(model.chat("给我讲个笑话"))
+def route_models(task, input_text):
+    """
+    按任务类型和输入长度选择模型，返回[选中的模型, 校验失败时依次升级的模型...]
+    """
+    ls_route = model_route_table.get(task)
+    if not ls_route:
+        return [default_llm_model]
+    input_tokens = count_tokens(input_text)
+    llm_model = ls_route[-1][1]
+    for max_input_tokens, model in ls_route:
+        if max_input_tokens is None or input_tokens <= max_input_tokens:
+            llm_model = model
+            break
+    if llm_model not in model_escalation_order:
+        return [llm_model]
+    return model_escalation_order[model_escalation_order.index(llm_model):]
 
 
+async def async_routed_llm_request(request, task, validate_func=None, input_text=None, system_content=None, temperature=0.0, max_tokens=None,
+                                   response_type="text", use_cache=None, refresh_cache=False):
+    """
+    按路由表选择模型请求大模型，回复经validate_func校验（校验失败时抛出异常），失败则升级到更大的模型
+    input_text为决定路由的输入（默认是整个request），返回validate_func处理后的结果，所有模型都失败时抛出最后一次的异常
+    同一次路由的所有请求在用量记录中共享route_id，用于统计路由节省的费用和耗时
+    """
+    ls_model = route_models(task, request if input_text is None else input_text)
+    token = _usage_route.set((uuid.uuid4().hex, default_llm_model))
+    try:
+        for i, llm_model in enumerate(ls_model):
+            reply = await async_llm_request(
+                request, system_content=system_content, temperature=temperature, max_tokens=max_tokens, llm_model=llm_model,
+                response_type=response_type, use_cache=use_cache, refresh_cache=refresh_cache
+            )
+            try:
+                if reply is None:
+                    raise ValueError(f"{llm_model}请求失败")
+                return validate_func(reply) if validate_func is not None else reply
+            except Exception:
+                if i == len(ls_model) - 1:
+                    raise
+                consume_retry()
+                logging.warning(f"{task}: {llm_model}的回复未通过校验，升级到{ls_model[i + 1]}")
+    finally:
+        _usage_route.reset(token)
+
+
+def llm_request(request, system_content=None, temperature=0.0, max_tokens=None, llm_model="gpt-4-1106-preview", response_type="text",
+                use_cache=None, refresh_cache=False):
+    try:
+        return run_coroutine_sync(
+            async_llm_request(
+                request, system_content=system_content, temperature=temperature, max_tokens=max_tokens, llm_model=llm_model,
+                response_type=response_type, use_cache=use_cache, refresh_cache=refresh_cache
+            )
+        )
+    except KeyboardInterrupt:
+        return
 
 
+def llm_request_many(requests, **kwargs):
+    """
+    在单个进程内并发请求一组prompt，llm_request的批量版本
+    """
+    try:
+        return run_coroutine_sync(async_llm_request_many(requests, **kwargs))
+    except KeyboardInterrupt:
+        return
+
+
+def llm_request_stream(request, system_content=None, temperature=0.0, max_tokens=None, llm_model="gpt-4-1106-preview", response_type="text",
+                       use_cache=None):
+    """
+    流式请求大模型的同步版本，返回逐个yield增量文本的生成器
+    """
+    return iterate_async_generator_sync(
+        async_llm_request_stream(
+            request, system_content=system_content, temperature=temperature, max_tokens=max_tokens, llm_model=llm_model,
+            response_type=response_type, use_cache=use_cache
+        )
+    )
+
+
+def routed_llm_request(request, task, validate_func=None, input_text=None, system_content=None, temperature=0.0, max_tokens=None,
+                       response_type="text", use_cache=None, refresh_cache=False):
+    """
+    async_routed_llm_request的同步版本
+    """
+    return run_coroutine_sync(
+        async_routed_llm_request(
+            request, task, validate_func=validate_func, input_text=input_text, system_content=system_content, temperature=temperature,
+            max_tokens=max_tokens, response_type=response_type, use_cache=use_cache, refresh_cache=refresh_cache
+        )
+    )
 
 
+if __name__ == '__main__':
+    model = GPT()
+    print(model.chat("给我讲个笑话"))
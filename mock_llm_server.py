@@ -0,0 +1,279 @@
+"""
+本地的OpenAI兼容mock服务，用于离线压测和调试流水线
+
+    python mock_llm_server.py --port 8765 --latency-median 2.0 --rate-429 0.05 --malformed-json-rate 0.1
+    STOCHASTICGPT_MOCK_LLM=http://127.0.0.1:8765/v1 streamlit run web_UI.py
+
+回复内容由prompt决定（同一prompt总是得到同一回复），延迟、429和JSON损坏按配置的概率随机注入
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockConfig:
+    def __init__(self, latency_median=1.0, latency_sigma=0.5, token_latency=0.0, rate_429=0.0, malformed_json_rate=0.0, seed=0):
+        # 请求延迟服从对数正态分布，latency_median为中位数（秒），latency_sigma为对数标准差
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        # 流式输出时每个片段的额外延迟（秒）
+        self.token_latency = token_latency
+        self.rate_429 = rate_429
+        self.malformed_json_rate = malformed_json_rate
+        self.seed = seed
+
+
+class MockState:
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "malformed_json": 0, "embeddings": 0}
+
+    def sample(self):
+        """
+        抽取一次请求的(延迟, 是否返回429, 是否损坏JSON)
+        """
+        config = self.config
+        with self.lock:
+            latency = 0.0
+            if config.latency_median > 0:
+                latency = math.exp(self.rng.gauss(math.log(config.latency_median), config.latency_sigma))
+            return latency, self.rng.random() < config.rate_429, self.rng.random() < config.malformed_json_rate
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+        return
+
+
+def _seed_of(text):
+    return int(md5(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _first_sentence(text, max_len=160):
+    text = re.sub(r"\s+", " ", re.sub(r"\\[a-zA-Z]+\*?(\[[^\]]*\])?(\{[^}]*\})?", "", text)).strip().strip('"')
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    return sentence[:max_len]
+
+
+def _between(prompt, start, end):
+    i = prompt.find(start)
+    if i < 0:
+        return ""
+    i += len(start)
+    j = prompt.find(end, i)
+    return prompt[i:j if j >= 0 else len(prompt)]
+
+
+def mock_overall_structure(prompt):
+    paper_text = prompt[prompt.rfind("Here's the paper for your review and analysis:"):]
+    nodes = [{"name": "Title", "type": "title", "parents": []}, {"name": "Abstract", "type": "abstract", "parents": ["Title"]}]
+    last_section = "Abstract"
+    for level, title in re.findall(r"\\(sub)*section\*?\{([^}]+)\}", paper_text):
+        if level:
+            nodes.append({"name": title, "type": "subsection", "parents": [last_section]})
+        else:
+            nodes.append({"name": title, "type": "section", "parents": [nodes[-1]["name"]]})
+            last_section = title
+    return {"nodes": nodes}
+
+
+def mock_section_structure(prompt):
+    section_label = _between(prompt, 'one particular section named "', '"')
+    section_content = _between(prompt, "The text of this section is as follows:", "To conduct the analysis")
+    paragraphs = [p for p in section_content.split("\n\n") if len(p.strip()) > 40][:6]
+    nodes = []
+    for i, paragraph in enumerate(paragraphs):
+        nodes.append({
+            "name": f"{section_label} Point {i + 1}",
+            "content": _first_sentence(paragraph),
+            "parents": [nodes[-1]["name"]] if nodes else [],
+        })
+    return {"nodes": nodes}
+
+
+def mock_section_analysis(prompt):
+    section_content = _between(prompt, "The content of the section is:", "Formatting Requirements:")
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+", re.sub(r"\s+", " ", section_content).strip()) if s]
+    if sentences:
+        sentences[0] = f"@{sentences[0]}@(This sentence could be more concise.)"
+    return (
+        "### Section Content with Annotations\n"
+        + " ".join(sentences)
+        + "\n### Logical Flow Commentary\nThe section is mostly coherent, but the transition between its first two ideas could be smoother."
+    )
+
+
+def mock_paper_scoring(prompt):
+    rng = random.Random(_seed_of(prompt))
+    return {key: rng.randint(5, 9) for key in ["Consistency", "Coherence", "Conciseness", "Substantiveness"]}
+
+
+def mock_reply(prompt):
+    """
+    根据prompt识别任务类型，返回(回复文本, 是否为JSON回复)
+    """
+    if "depicts the contextual relationships throughout the paper" in prompt:
+        return json.dumps(mock_overall_structure(prompt)), True
+    if "dissecting the internal logical structure" in prompt:
+        return json.dumps(mock_section_structure(prompt)), True
+    # 按分析任务的指令识别，改写prompt中引用的分析结果（包含"Section Content with Annotations"）不会被误判
+    if "check it for language proficiency and logical flow" in prompt:
+        return mock_section_analysis(prompt), False
+    if '"Consistency", "Coherence"' in prompt:
+        return "```json\n" + json.dumps(mock_paper_scoring(prompt)) + "\n```", True
+    section_content = _between(prompt, "The content of the section is:", "The review advise is:").strip()
+    if section_content:
+        return section_content, False
+    return f"Mock reply {md5(prompt.encode('utf-8')).hexdigest()[:8]}", False
+
+
+def corrupt_json(reply, rng):
+    """
+    模拟常见的JSON损坏：截断、尾随逗号、单引号，返回(损坏后的回复, finish_reason)，截断时finish_reason为length
+    """
+    choice = rng.randint(0, 2)
+    if choice == 0:
+        return reply[: max(1, int(len(reply) * 0.8))], "length"
+    if choice == 1:
+        return re.sub(r"\]", ",]", reply, count=1), "stop"
+    return reply.replace('"', "'"), "stop"
+
+
+def _chunks(text, size=16):
+    return [text[i : i + size] for i in range(0, len(text), size)] or [""]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        return
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.state.stats)
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            self.chat_completions(payload)
+        elif self.path.endswith("/embeddings"):
+            self.embeddings(payload)
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def chat_completions(self, payload):
+        state = self.state
+        state.count("requests")
+        latency, rate_limited, malformed = state.sample()
+        if rate_limited:
+            state.count("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}})
+            return
+
+        prompt = "\n".join([item.get("content", "") for item in payload.get("messages", [])])
+        reply, is_json = mock_reply(prompt)
+        finish_reason = "stop"
+        if is_json and malformed:
+            state.count("malformed_json")
+            reply, finish_reason = corrupt_json(reply, random.Random(_seed_of(prompt)))
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(reply) // 4
+        model = payload.get("model", "mock")
+
+        time.sleep(latency)
+        if not payload.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for piece in _chunks(reply) + [None]:
+            delta = {"content": piece} if piece is not None else {}
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None if piece is not None else finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if state.config.token_latency > 0:
+                time.sleep(state.config.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def embeddings(self, payload):
+        self.state.count("embeddings")
+        texts = payload.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            rng = random.Random(_seed_of(text))
+            vector = [rng.gauss(0, 1) for _ in range(1536)]
+            norm = math.sqrt(sum([v * v for v in vector]))
+            data.append({"object": "embedding", "index": i, "embedding": [v / norm for v in vector]})
+        tokens = sum([len(text) // 4 for text in texts])
+        self._send_json(200, {"object": "list", "data": data, "model": payload.get("model"), "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=8765):
+    """
+    在后台线程中启动mock服务，返回server（调用server.shutdown()停止）
+    """
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"state": MockState(config or MockConfig())})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock_llm_server", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-median", type=float, default=1.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--malformed-json-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency_median, args.latency_sigma, args.token_latency, args.rate_429, args.malformed_json_rate, args.seed)
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"state": MockState(config)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"Mock LLM server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
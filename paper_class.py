@@ -1,6 +1,5 @@
-import copy
 import os
-import re
+from hashlib import md5
 
 import json
 import traceback
@@ -10,6 +9,7 @@ import joblib
 from llm_api import GPT, parse_json, llm_request
 from langchain.document_loaders.text import TextLoader
 from langchain.text_splitter import LatexTextSplitter
+from latex_sections import get_section_index
 from util import multiprocess, get_cpu_count
 
 root_cache_path = "../StochasticGPT_data/cache"
@@ -31,44 +31,50 @@ def save_cache(paper):
 
 
 def replace_section_content(latex_content, section_title, new_content):
-    # 转义为正则表达式的特殊字符
-    escaped_title = re.escape(section_title)
-
-    # 构建查找section或subsection的正则表达式
-    section_regex = re.compile(
-        r"(\\section\{" + escaped_title + r"\}|\\subsection\{" + escaped_title + r"\})"
-                                                                                 ".*?"
-                                                                                 r"(?=\\section|\\subsection|$)",
-        re.DOTALL
-    )
-
-    # 在文档中查找对应的section或subsection
-    match = section_regex.search(latex_content)
-    if match:
-        start_index = match.start()
-        end_index = match.end()
-
-        # 替换section内容
-        replaced_content = (
-                latex_content[:start_index] +
-                match.group(1) + "\n" + new_content + "\n" +
-                latex_content[end_index:]
-        )
-
-        return replaced_content
-    else:
+    """
+    将标题（label）为section_title的章节正文替换为new_content，章节命令和子章节保持不变
+    """
+    section_index = get_section_index(latex_content)
+    if section_index.get(section_title) is None:
         # 没有找到对应的section或subsection
         print("Section or Subsection not found.")
         return latex_content
+    return section_index.replace_contents({section_title: new_content})
 
 
 def get_polishing_paper(paper_content, dt_polishing_result):
-    polishing_paper = copy.deepcopy(paper_content)
-    for section_label in dt_polishing_result.keys():
-        section_polishing_result = dt_polishing_result[section_label]
-        if len(section_polishing_result) > 0:
-            polishing_paper = replace_section_content(polishing_paper, section_label, section_polishing_result)
-    return polishing_paper
+    """
+    将所有非空的润色结果替换回原文，对章节树只解析一次
+    """
+    dt_polishing_result = {section_label: result for section_label, result in dt_polishing_result.items() if len(result) > 0}
+    return get_section_index(paper_content).replace_contents(dt_polishing_result)
+
+
+def get_section_hashes(dt_section_content):
+    """
+    计算每个section正文的hash，用于判断重新上传的论文中哪些section没有修改
+    """
+    return {section_label: md5(section_content.encode("utf-8")).hexdigest() for section_label, section_content in dt_section_content.items()}
+
+
+def get_section_outline(paper_content):
+    """
+    论文的大纲：按文档顺序排列的(层级, 标题)
+    """
+    return [(node.level, node.title) for node in get_section_index(paper_content).nodes]
+
+
+def export_polishing_paper(paper):
+    """
+    导出润色后的论文，返回(文件名, 文件内容, 无法写回的section_label列表)
+    多文件项目把润色结果写回各章节所在的源文件后整体打包成zip，单个.tex文件直接导出替换后的全文
+    """
+    dt_polishing_result = {section_label: result for section_label, result in paper.dt_polishing_result.items() if len(result) > 0}
+    if paper.latex_project is not None:
+        dt_file_text, ls_skipped = paper.latex_project.write_back(dt_polishing_result)
+        return f"polished_{paper.file_name}", paper.latex_project.export_zip(dt_file_text), ls_skipped
+    polishing_paper = get_polishing_paper(paper.paper_content, dt_polishing_result)
+    return f"polished_{paper.file_name}", polishing_paper.encode("utf-8"), []
 
 
 class Paper:
@@ -84,18 +90,55 @@ class Paper:
         self.paper_score = None
         self.dt_score = None
         self.dt_polishing_result = None
-
-    def initial_polishing_result(self):
+        self.dt_section_hash = None
+        # 上传的是多文件项目（.zip）时保存项目，用于将润色结果写回源文件，不写入缓存
+        self.latex_project = None
+
+    def initial_polishing_result(self, previous_paper=None):
+        """
+        初始化润色结果，给定previous_paper时沿用其中未修改section的润色结果
+        """
+        ls_unchanged = previous_paper.unchanged_sections(self.dt_section_content) if previous_paper is not None else []
         self.dt_polishing_result = {}
         for section_label in self.dt_section_content.keys():
             self.dt_polishing_result[section_label] = ""
+            if section_label in ls_unchanged:
+                self.dt_polishing_result[section_label] = (previous_paper.dt_polishing_result or {}).get(section_label, "")
+
+    def update_section_hash(self):
+        self.dt_section_hash = get_section_hashes(self.dt_section_content) if self.dt_section_content is not None else None
+
+    def unchanged_sections(self, dt_section_content):
+        """
+        返回dt_section_content中与本论文同名且正文相同、并且已有分析结果的section_label
+        """
+        if self.dt_section_hash is None or self.dt_section_structure is None:
+            return []
+        ls_unchanged = []
+        for section_label, section_hash in get_section_hashes(dt_section_content).items():
+            if self.dt_section_hash.get(section_label) == section_hash and self.dt_section_structure.get(section_label) is not None:
+                ls_unchanged.append(section_label)
+        return ls_unchanged
+
+    def outline_changed(self, paper_content):
+        """
+        判断paper_content的大纲（各级标题及其顺序）与本论文相比是否发生变化
+        """
+        if self.paper_content is None or self.overall_structure is None:
+            return True
+        return get_section_outline(self.paper_content) != get_section_outline(paper_content)
 
     def get_cache(self):
         return [self.title, self.paper_content, self.overall_structure, self.dt_section_structure, self.dt_section_content,
-                self.dt_analysis_result, self.paper_score, self.dt_score, self.dt_polishing_result]
+                self.dt_analysis_result, self.paper_score, self.dt_score, self.dt_polishing_result, self.dt_section_hash]
 
     def load_cache(self, ls_cache):
-        self.title, self.paper_content, self.overall_structure, self.dt_section_structure, self.dt_section_content, self.dt_analysis_result, self.paper_score, self.dt_score, self.dt_polishing_result = ls_cache
+        self.title, self.paper_content, self.overall_structure, self.dt_section_structure, self.dt_section_content, self.dt_analysis_result, self.paper_score, self.dt_score, self.dt_polishing_result = ls_cache[:9]
+        # 旧版本的缓存只有9项，没有section的hash，加载时根据正文计算
+        if len(ls_cache) > 9:
+            self.dt_section_hash = ls_cache[9]
+        else:
+            self.update_section_hash()
 
 
 if __name__ == '__main__':
@@ -4,7 +4,7 @@ import traceback
 
 from langchain.document_loaders import TextLoader
 
-from llm_api import GPT, parse_json, llm_request
+from llm_api import GPT, parse_json, llm_request, usage_context, consume_retry, LLMCancelled, RetryBudgetExhausted
 from util import multiprocess, get_cpu_count
 
 
@@ -40,6 +40,21 @@ Please provide your ratings in JSON format, with keys for "Consistency", "Cohere
 """
 
 
+score_keys = ("Consistency", "Coherence", "Conciseness", "Substantiveness")
+
+
+def validate_score(dt_score):
+    """
+    检查打分结果包含全部四项且分数为数字，截断修复得到的不完整结果抛出ValueError，由调用方重新请求
+    """
+    if not isinstance(dt_score, dict):
+        raise ValueError(f"打分结果不是JSON对象: {dt_score}")
+    missing_keys = [key for key in score_keys if not isinstance(dt_score.get(key), (int, float))]
+    if missing_keys:
+        raise ValueError(f"打分结果缺少{missing_keys}: {dt_score}")
+    return {key: dt_score[key] for key in score_keys}
+
+
 def paper_scoring(paper_content):
     print("Paper scoring")
     request = paper_scoring_prompt.format(paper_content=paper_content)
@@ -47,11 +62,16 @@ def paper_scoring(paper_content):
     try_count = 0
     while try_count < max_try:
         try:
-            reply = llm_request(request)
-            dt_score = parse_json(reply)
+            if try_count > 0:
+                consume_retry()
+            with usage_context(stage="paper_scoring"):
+                reply = llm_request(request, refresh_cache=try_count > 0)
+            dt_score = validate_score(parse_json(reply))
             return dt_score
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, LLMCancelled):
             return
+        except RetryBudgetExhausted:
+            raise
         except:
             traceback.print_exc()
             try_count += 1
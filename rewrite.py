@@ -5,10 +5,12 @@ from dotenv import load_dotenv
 # load_dotenv(dotenv_path = ".env")
 # openai.api_base = os.environ["OPENAI_API_BASE"]
 # openai.api_key = os.environ["OPENAI_API_KEY"]
-from llm_api import llm_request
-from util import multiprocess, get_cpu_count
+from llm_api import get_llm_parallelism, llm_request, llm_request_stream, usage_context
+from util import multiprocess
+from structure_extraction import compact_structure
+from token_counter import count_tokens
 
-def rewrite_language_issue(section_label, section_content, section_review):
+def rewrite_language_issue(section_label, section_content, section_review, stream=False):
 
     example = {'example_content': """\\section\{Introduction\}\nThe Urban Life and Air Pollution task at MediaEval 2022 required participants to predict the air quality index (AQI) value at +1, +5 and +7 days using an archive of air quality, weather and images from 16 CCTV cameras, one image taken every 60 seconds \cite{UA22}. Participating groups were required to download the data from online sources for local processing.
     Gaps in air quality datasets are common with the problem exacerbated for data gathered in poorer or developing countries \cite{PINDER2019116794, Falge2001, Hui2004, Moffat2007, Kim2020}. In this paper we describe how we addressed the very large gaps in data that we encountered in the data we downloaded.""", 
@@ -49,7 +51,10 @@ Gaps in air quality datasets are common with the problem exacerbated for data ga
     prompt = language_issue_prompt.format(section_content = section_content, section_label = section_label, review_advise = section_review, \
         example_review = example["example_review"], example_content = example["example_content"], revise_result = example["revise_result"])
     
-    response = llm_request(prompt)
+    with usage_context(stage="rewrite_language"):
+        if stream:
+            return llm_request_stream(prompt)
+        response = llm_request(prompt)
     return response
 
 def rewrite_language_issue_async(dt_section, dt_review):
@@ -64,12 +69,13 @@ def rewrite_language_issue_async(dt_section, dt_review):
     ls_analysis_result = multiprocess(
         func=fun,
         paras=ls_section_pair,
-        n_processes=min(len(ls_section_pair), get_cpu_count())
+        n_processes=get_llm_parallelism(len(ls_section_pair)),
+        cost_func=lambda section_pair: count_tokens(section_pair[1])
     )
     return ls_analysis_result
 
 
-def rewrite_logic_issue(section_label, section_content, section_review, section_structure):
+def rewrite_logic_issue(section_label, section_content, section_review, section_structure, stream=False):
     example_structure = {'nodes': [
                       {'name': 'Challenge Overview',
                        'content': 'The Urban Life and Air Pollution task at MediaEval 2022 is introduced, which required participants to predict the air quality index (AQI) value at future intervals using a variety of data sources.',
@@ -140,10 +146,13 @@ def rewrite_logic_issue(section_label, section_content, section_review, section_
 
                 Ensure your response fully complies with requirements and fulfill the task effectively. You should output your further modified text directly in Latex format."""
                 
-    prompt = logic_issue_prompt.format(section_label=section_label, section_content=section_content, section_structure=section_structure, review_advise=section_review, \
-        example_content=example["example_content"], example_structure=example["example_structure"], example_review=example["example_review"], revise_result=example["example_result"])
+    prompt = logic_issue_prompt.format(section_label=section_label, section_content=section_content, section_structure=compact_structure(section_structure), review_advise=section_review, \
+        example_content=example["example_content"], example_structure=compact_structure(example["example_structure"]), example_review=example["example_review"], revise_result=example["example_result"])
 
-    response = llm_request(prompt)
+    with usage_context(stage="rewrite_logic"):
+        if stream:
+            return llm_request_stream(prompt)
+        response = llm_request(prompt)
     return response
     
 def rewrite_logic_issue_async(dt_section, dt_section_structure, dt_review):
@@ -158,12 +167,13 @@ def rewrite_logic_issue_async(dt_section, dt_section_structure, dt_review):
     ls_analysis_result = multiprocess(
         func=fun,
         paras=ls_section_pair,
-        n_processes=min(len(ls_section_pair), get_cpu_count())
+        n_processes=get_llm_parallelism(len(ls_section_pair)),
+        cost_func=lambda section_pair: count_tokens(section_pair[1])
     )
     return ls_analysis_result
     
 
-def reflect(section_label, original_text, logical_structure, review_advise, modified_text):
+def reflect(section_label, original_text, logical_structure, review_advise, modified_text, stream=False):
     revise_requirements = """The modification should adhere to three criteria: 
                 (1) fidelity, ensuring that the revised text is faithful to the intent and content of original section and does not add information that is not in the original section, and 
                 (2) improved logical flow, making the content more academically sound, clear, and engaging, and
@@ -217,7 +227,7 @@ def reflect(section_label, original_text, logical_structure, review_advise, modi
 
     The reflection results have been directly generated, and based on the analysis, the modifications have fully met the review advice and the specified revise requirements. No further modification needed."""
     
-    example = f""" "example_content": {example_content} \n\n"logical structure": {example_structure} \n\n"review advice": {example_feedback} \n\n"modified version": {example_modified_text} \n
+    example = f""" "example_content": {example_content} \n\n"logical structure": {compact_structure(example_structure)} \n\n"review advice": {example_feedback} \n\n"modified version": {example_modified_text} \n
     "reflection": {example_reflect}"""
          
     reflect_prompt = """You are tasked with refining a section of an academic paper. a section (titled "{section_label}") of an academic paper in Latex format, has been previously revised based on a review advise.
@@ -251,13 +261,16 @@ def reflect(section_label, original_text, logical_structure, review_advise, modi
 
                         Please analyze your previous modification and provide your reflection.
                         """
-    prompt = reflect_prompt.format(section_label=section_label, original_text=original_text, logical_structure=logical_structure, review_advise=review_advise, revise_requirements=revise_requirements, \
+    prompt = reflect_prompt.format(section_label=section_label, original_text=original_text, logical_structure=compact_structure(logical_structure), review_advise=review_advise, revise_requirements=revise_requirements, \
         modified_text=modified_text, examples=example)
 
-    response = llm_request(prompt)
+    with usage_context(stage="reflect"):
+        if stream:
+            return llm_request_stream(prompt)
+        response = llm_request(prompt)
     return response
 
-def modify_based_on_reflect(section_label, original_text, logical_structure, review_advise, modified_text, unsatisfied_points):
+def modify_based_on_reflect(section_label, original_text, logical_structure, review_advise, modified_text, unsatisfied_points, stream=False):
     revise_requirements = """The modification should adhere to three criteria: 
                 (1) fidelity, ensuring the revised text remains true to the original intent and content, and 
                 (2) improved logical flow, making the content more academically sound, clear, and engaging, and
@@ -320,7 +333,7 @@ def modify_based_on_reflect(section_label, original_text, logical_structure, rev
 
     The Urban Life and Air Pollution task at MediaEval 2022 presented a challenge that required participants to predict the air quality index (AQI) value at +1, +5, and +7 days using an archive of air quality, weather data, and images from 16 CCTV cameras, captured at one-minute intervals \cite{UA22}. This task underscored the critical need for accurate air quality forecasting, particularly in light of the frequent data gaps that are prevalent in datasets from less affluent regions \cite{PINDER2019116794, Falge2001, Hui2004, Moffat2007, Kim2020}. Our paper addresses these challenges by detailing a novel approach to mitigate the impact of substantial data gaps encountered in the datasets we analyzed. Through this work, we aim to contribute to the broader effort of improving air quality predictions, which is essential for public health and policy-making, especially in areas where data scarcity hinders environmental monitoring and management."""
         
-    example = f""" "Original Section": {example_content} \n\n"Logical Structure of Original Text": {example_structure} \n\n"Review Advice": {example_feedback} \n\n"Revision Requirements": {revise_requirements}\n
+    example = f""" "Original Section": {example_content} \n\n"Logical Structure of Original Text": {compact_structure(example_structure)} \n\n"Review Advice": {example_feedback} \n\n"Revision Requirements": {revise_requirements}\n
     "Your Modified Version": {example_modified_text} \n\n"Unsatisfied Points of Modified Version": {example_reflect} \n\n"Furether Modified Result": {example_further_modify}"""
                 
     remodify_prompt = """Objective: You are required to refine a section of an academic paper. This section, titled "{section_label}," has undergone previous revisions based on review advice. 
@@ -351,13 +364,19 @@ def modify_based_on_reflect(section_label, original_text, logical_structure, rev
                         
                         You should output your further modified text directly in Latex format.
                         """
-    prompt = remodify_prompt.format(section_label=section_label, original_text=original_text, logical_structure=logical_structure, review_advise=review_advise, revise_requirements=revise_requirements, \
+    prompt = remodify_prompt.format(section_label=section_label, original_text=original_text, logical_structure=compact_structure(logical_structure), review_advise=review_advise, revise_requirements=revise_requirements, \
         modified_text=modified_text, unsatisfied_points=unsatisfied_points, examples=example)
     
-    response = llm_request(prompt)
+    with usage_context(stage="modify_based_on_reflect"):
+        if stream:
+            return llm_request_stream(prompt)
+        response = llm_request(prompt)
     return response
 
-def rewrite_logic_issue_reflect(section_label, section_content, section_review, section_structure, runs=1):
+def rewrite_logic_issue_reflect(section_label, section_content, section_review, section_structure, runs=1, stream=False):
+    if stream:
+        return _rewrite_logic_issue_reflect_stream(section_label, section_content, section_review, section_structure, runs)
+
     modified_text = rewrite_logic_issue(section_label, section_content, section_review, section_structure)
     
     for run in range(runs):
@@ -369,6 +388,32 @@ def rewrite_logic_issue_reflect(section_label, section_content, section_review,
         
     return modified_text
 
+def stream_channel(channel, deltas):
+    """
+    将增量文本累积成(channel, 当前完整文本)的事件流，channel为"analysis"或"polish"
+    """
+    ls_delta = []
+    for delta in deltas:
+        ls_delta.append(delta)
+        yield channel, "".join(ls_delta)
+
+def _rewrite_logic_issue_reflect_stream(section_label, section_content, section_review, section_structure, runs=1):
+    # 初稿和每轮修改稿都作为"polish"流输出，反思结果作为"analysis"流输出
+    modified_text = ""
+    for channel, modified_text in stream_channel("polish", rewrite_logic_issue(section_label, section_content, section_review, section_structure, stream=True)):
+        yield channel, modified_text
+
+    for run in range(runs):
+        reflect_result = ""
+        for channel, reflect_result in stream_channel("analysis", reflect(section_label, section_content, section_structure, section_review, modified_text, stream=True)):
+            yield channel, reflect_result
+        futher_modified_text = ""
+        for channel, futher_modified_text in stream_channel("polish", modify_based_on_reflect(section_label, section_content, section_structure, section_review, modified_text, reflect_result, stream=True)):
+            yield channel, futher_modified_text
+
+        modified_text = futher_modified_text
+        section_review = section_review + '\n' + reflect_result
+
 def rewrite_logic_issue_async_reflect(dt_section, dt_section_structure, dt_review, runs=1):
 
     def fun(section_pair):
@@ -381,7 +426,8 @@ def rewrite_logic_issue_async_reflect(dt_section, dt_section_structure, dt_revie
     ls_analysis_result = multiprocess(
         func=fun,
         paras=ls_section_pair,
-        n_processes=min(len(ls_section_pair), get_cpu_count())
+        n_processes=get_llm_parallelism(len(ls_section_pair)),
+        cost_func=lambda section_pair: count_tokens(section_pair[1])
     )
     return ls_analysis_result
 
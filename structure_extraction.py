@@ -3,10 +3,13 @@ import re
 import json
 import traceback
 
-from llm_api import GPT, parse_json, llm_request
+from llm_api import GPT, parse_json, llm_request, routed_llm_request, usage_context, consume_retry, get_llm_parallelism, LLMCancelled, RetryBudgetExhausted
 from langchain.document_loaders.text import TextLoader
 from langchain.text_splitter import LatexTextSplitter
-from util import multiprocess, get_cpu_count
+from json_repair import repair_json
+from latex_sections import get_section_index
+from token_counter import count_tokens, split_text_by_budget
+from util import multiprocess, multiprocess_as_completed
 
 
 def strip_comments(latex_content):
@@ -132,10 +135,13 @@ section_structure_json_example = {
     ]
 }
 
+# 超过该token数的section按段落切分后分别抽取结构，再合并成一个DAG
+section_chunk_tokens = 3000
+
 section_structure_prompt = """
 I am currently working on a research paper and require assistance in analyzing a specific section. 
 The paper's structure is represented by the following JSON-encoded directed acyclic graph (DAG), which has nodes designated as the title, abstract, sections, and subsections: {paper_structure}.
-I am interested in dissecting the internal logical structure of one particular section named "{section_label}". The text of this section is as follows:
+I am interested in dissecting the internal logical structure of one particular section named "{section_label}".{section_part} The text of this section is as follows:
 
 "{section_content}"
 
@@ -143,7 +149,7 @@ To conduct the analysis, please follow these steps:
 
 Examine the text provided for the "{section_label}" section to identify its internal logical structure.
 Break down this structure into its elemental components, such as claims, arguments, evidence, and conclusions.
-Create a graphical representation of this section's logical structure, ensuring each node includes 'name', 'content', and 'parents' to define its relationship with other components of the section.
+Create a graphical representation of this section's logical structure, ensuring each node includes 'name', 'content', and 'parents' to define its relationship with other components of the section (the 'parents' links are the edges of the graph, so no separate edge list is needed).
 Provide the breakdown in a clear and structured JSON format.
 The final JSON should reflect the specific section's internal logic and how each part contributes to the overall argument. Please ensure no node names are duplicated from those of the overall paper's DAG.
 
@@ -153,47 +159,123 @@ Kindly generate logical flow of the section content in JSON format, detailing th
 """
 
 
+def _is_ancestor(name, node_name, dt_parents):
+    stack = [node_name]
+    seen = set()
+    while stack:
+        current = stack.pop()
+        if current == name:
+            return True
+        if current in seen:
+            continue
+        seen.add(current)
+        stack.extend(dt_parents.get(current, ()))
+    return False
+
+
+def _drop_cycle_parents(nodes):
+    """
+    Keeps the parent links in node order and drops every link that would close a cycle, so the structure is a DAG.
+    """
+    dt_parents = {}
+    for node in nodes:
+        name = node.get("name")
+        parents = []
+        for parent in node["parents"]:
+            if parent == name or _is_ancestor(name, parent, dt_parents):
+                continue
+            parents.append(parent)
+            dt_parents.setdefault(name, set()).add(parent)
+        node["parents"] = parents
+    return nodes
+
+
+def normalize_structure(structure):
+    """
+    Normalizes a DAG structure so that every node carries its 'parents' and the 'edges' list is derived from them.
+    Replies that only give 'edges' are converted the other way round first. Parent links that would close a cycle
+    are dropped, so a cyclic reply (or a cyclic part of a long section) still yields a DAG with at least one root.
+    """
+    if not isinstance(structure, dict):
+        return structure
+    nodes = [dict(node) for node in structure.get("nodes", [])]
+    dt_parents = {}
+    for edge in structure.get("edges", []):
+        if isinstance(edge, dict) and "from" in edge and "to" in edge:
+            dt_parents.setdefault(edge["to"], []).append(edge["from"])
+    for node in nodes:
+        parents = list(node.get("parents") or [])
+        for parent in dt_parents.get(node.get("name"), []):
+            if parent not in parents:
+                parents.append(parent)
+        node["parents"] = parents
+    _drop_cycle_parents(nodes)
+    edges = [{"from": parent, "to": node.get("name")} for node in nodes for parent in node["parents"]]
+    normalized = dict(structure)
+    normalized["nodes"] = nodes
+    normalized["edges"] = edges
+    return normalized
+
+
+def validate_structure(structure, node_keys=("name",)):
+    """
+    Checks a parsed DAG reply against the node/edge schema: 'nodes' is a list of objects carrying every key in node_keys,
+    'parents' and 'edges' only refer to existing node names. Dangling references are dropped (cycles are broken by
+    normalize_structure); a reply that is not a structure at all raises ValueError so that the caller requests it again.
+    """
+    if not isinstance(structure, dict) or not isinstance(structure.get("nodes"), list):
+        raise ValueError("structure reply has no 'nodes' list")
+    nodes = []
+    for node in structure["nodes"]:
+        if not isinstance(node, dict) or not isinstance(node.get("name"), str) or not node["name"]:
+            raise ValueError(f"invalid node {node}")
+        missing_keys = [key for key in node_keys if key not in node]
+        if missing_keys:
+            raise ValueError(f"node {node['name']} is missing {missing_keys}")
+        nodes.append(dict(node))
+    names = set([node["name"] for node in nodes])
+    for node in nodes:
+        parents = node.get("parents") or []
+        if isinstance(parents, str):
+            parents = [parents]
+        node["parents"] = [parent for parent in parents if parent in names and parent != node["name"]]
+    edges = structure.get("edges") or []
+    validated = dict(structure)
+    validated["nodes"] = nodes
+    validated["edges"] = [
+        edge for edge in (edges if isinstance(edges, list) else [])
+        if isinstance(edge, dict) and edge.get("from") in names and edge.get("to") in names
+    ]
+    return validated
+
+
+def parse_structure(reply, node_keys=("name",)):
+    """
+    Parses a structure reply, repairing common JSON defects locally, then validates and normalizes it.
+    A reply cut off mid-structure raises ValueError instead of being closed with the unfinished nodes dropped,
+    so the caller requests it again rather than accepting a partial tree.
+    """
+    return normalize_structure(validate_structure(repair_json(reply, allow_truncated=False), node_keys))
+
+
+def compact_structure(structure):
+    """
+    Encodes a DAG structure for a prompt as minified JSON.
+    The edge list is left out because it repeats the 'parents' of each node.
+    """
+    if not isinstance(structure, dict):
+        return str(structure)
+    nodes = normalize_structure(structure)["nodes"]
+    return json.dumps({"nodes": nodes}, ensure_ascii=False, separators=(",", ":"))
+
+
 def extract_sections(latex_text):
     """
-    Extracts sections and subsections from a LaTeX document into a dictionary.
-    If a section contains subsections, only the subsections are extracted.
+    Extracts the sections of a LaTeX document into a dictionary {section_label: content} in document order.
+    Sections without text of their own (e.g. a section that directly starts with a subsection) are skipped,
+    and repeated titles are labelled "Title (2)", "Title (3)", ... (see latex_sections.parse_section_tree).
     """
-    # Initialize the pattern for sections and subsections
-    pattern = r'\\(sub)*section\{([^\}]+)\}'
-
-    # Find all section/subsection commands and their titles
-    section_titles = re.findall(pattern, latex_text)
-
-    # Initialize the dictionary to store results
-    sections = {}
-    current_section = ""
-    current_content = ""
-    collecting = False
-
-    # Process the LaTeX line by line
-    for line in latex_text.splitlines():
-        # Check if we are at the start of a new section/subsection
-        match = re.match(pattern, line)
-        if match:
-            # Save the previous section if we were collecting its content
-            if collecting:
-                # Only keep non-empty sections and avoid nested section overrides
-                if current_content.strip() and current_section not in sections:
-                    sections[current_section] = current_content.strip()
-                current_content = ""
-
-            # Set the new section title
-            current_section = match.group(2).strip()
-            collecting = True
-        elif collecting:
-            # Accumulate the lines of content for the current section
-            current_content += line + "\n"
-
-    # Save the last section
-    if collecting and current_content.strip():
-        sections[current_section] = current_content.strip()
-
-    return sections
+    return get_section_index(latex_text).section_contents()
 
 
 def extract_and_convert_json(input_text):
@@ -207,7 +289,7 @@ def extract_and_convert_json(input_text):
     json_str = input_text[json_start:json_end].strip()
 
     # Convert the JSON string into a Python dictionary
-    python_dict = json.loads(json_str)
+    python_dict = repair_json(json_str)
 
     return python_dict
 
@@ -217,59 +299,183 @@ def extract_overall_structure(paper_text):
     try_count = 0
     while try_count < max_try:
         try:
-            request = overall_structure_extraction_prompt.format(json_example=overall_structure_extraction_json_example, paper_text=paper_text)
-            reply = llm_request(request, response_type="json_object")
+            if try_count > 0:
+                consume_retry()
+            request = overall_structure_extraction_prompt.format(json_example=compact_structure(overall_structure_extraction_json_example),
+                                                                 paper_text=paper_text)
+            with usage_context(stage="overall_structure"):
+                reply = llm_request(request, response_type="json_object", refresh_cache=try_count > 0)
             # reply = model.chat(request, response_type="json_object")
-            overall_structure_json = parse_json(reply)
+            overall_structure_json = parse_structure(reply, node_keys=("name", "type"))
             return overall_structure_json
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, LLMCancelled):
             return
+        except RetryBudgetExhausted:
+            raise
         except:
             traceback.print_exc()
             try_count += 1
 
 
-def extract_section_structure(section, paper_structure):
+def extract_section_structure(section, paper_structure, part_index=0, part_num=1):
+    """
+    Extracts the internal logical structure of a section. For a long section split into part_num parts,
+    only the part with index part_index is given and its structure is merged by merge_section_structures.
+    """
     section_label, section_content = section
+    section_part = ""
+    if part_num > 1:
+        section_part = (f" Because the section is long, only part {part_index + 1} of {part_num} is given here;"
+                        f" describe the logical structure of this part only.")
     if len(section_content) < 100:
         return {"nodes": [], "edges": []}
     max_try = 3
     try_count = 0
     while try_count < max_try:
         try:
-            request = section_structure_prompt.format(paper_structure=paper_structure, section_label=section_label, section_content=section_content,
-                                                      json_example=section_structure_json_example)
+            if try_count > 0:
+                consume_retry()
+            request = section_structure_prompt.format(paper_structure=compact_structure(paper_structure), section_label=section_label,
+                                                      section_part=section_part, section_content=section_content,
+                                                      json_example=compact_structure(section_structure_json_example))
             # reply = model.chat(request, response_type="json_object")
-            reply = llm_request(request, response_type="json_object")
-            section_structure_json = parse_json(reply)
+            # 短section用小模型抽取，回复无法解析为JSON时升级到大模型
+            with usage_context(stage="section_structure"):
+                section_structure_json = routed_llm_request(
+                    request, "section_structure", validate_func=lambda reply: parse_structure(reply, node_keys=("name", "content")),
+                    input_text=section_content, response_type="json_object", refresh_cache=try_count > 0
+                )
             print(section_structure_json)
             return section_structure_json
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, LLMCancelled):
             return
+        except RetryBudgetExhausted:
+            raise
         except:
             traceback.print_exc()
             try_count += 1
 
 
-def extract_paper_structure(paper_text):
-    print("Extracting overall structure")
-    overall_structure_json = extract_overall_structure(paper_text)
-    print(overall_structure_json)
+def split_section(section_content, max_tokens=None):
+    """
+    Splits a section longer than max_tokens (section_chunk_tokens by default) into paragraph-aligned chunks.
+    Shorter sections are returned as a single chunk.
+    """
+    max_tokens = max_tokens or section_chunk_tokens
+    if count_tokens(section_content) <= max_tokens:
+        return [section_content]
+    return split_text_by_budget(section_content, max_tokens)
+
+
+def merge_section_structures(ls_structure):
+    """
+    Deterministically merges the structures extracted from consecutive parts of one section into a single DAG.
+    Node names already used (in an earlier part or earlier in the same part) are suffixed with the part number, and
+    a parent reference points to the closest preceding node of that name in the same part. The root nodes of each
+    part are attached to the last node without children of the previous part, so the parts read as one logical flow.
+    Returns None if any part failed.
+    """
+    if any(structure is None for structure in ls_structure):
+        return None
+    if len(ls_structure) == 1:
+        return ls_structure[0]
+    nodes = []
+    names = set()
+    last_sink = None
+    for part_index, structure in enumerate(ls_structure):
+        part_nodes = normalize_structure(structure).get("nodes", [])
+        ls_name = []
+        for node in part_nodes:
+            name = node["name"]
+            suffix_num = 1
+            while name in names:
+                name = f"{node['name']} ({part_index + 1})" if suffix_num == 1 else f"{node['name']} ({part_index + 1}-{suffix_num})"
+                suffix_num += 1
+            ls_name.append(name)
+            names.add(name)
+        # the first occurrence of each name serves parent references that appear before the name is defined
+        dt_first = {}
+        for node, name in zip(part_nodes, ls_name):
+            dt_first.setdefault(node["name"], name)
+        dt_rename = {}
+        part_nodes_merged = []
+        for node, name in zip(part_nodes, ls_name):
+            merged_node = dict(node)
+            merged_node["name"] = name
+            merged_node["parents"] = [dt_rename.get(parent, dt_first.get(parent, parent)) for parent in node["parents"]]
+            if not merged_node["parents"] and last_sink is not None:
+                merged_node["parents"] = [last_sink]
+            dt_rename[node["name"]] = name
+            part_nodes_merged.append(merged_node)
+        part_children = set([parent for node in part_nodes_merged for parent in node["parents"]])
+        ls_sink = [node["name"] for node in part_nodes_merged if node["name"] not in part_children]
+        nodes += part_nodes_merged
+        if ls_sink:
+            last_sink = ls_sink[-1]
+    return normalize_structure({"nodes": nodes})
+
+
+def _extract_section_part_structure(section_part, paper_structure):
+    section_label, section_content, part_index, part_num = section_part
+    return extract_section_structure((section_label, section_content), paper_structure, part_index=part_index, part_num=part_num)
+
+
+def iter_section_structures(dt_section, overall_structure):
+    """
+    Extracts the structures of all sections in parallel (longest first) and yields (section_label, structure)
+    as each one finishes. Long sections are split into parts that are extracted in parallel alongside the other
+    sections and merged once all of their parts are done, so latency follows the longest part, not the longest section.
+    """
+    ls_section_part = []
+    for section_label, section_content in dt_section.items():
+        ls_chunk = split_section(section_content)
+        for part_index, chunk in enumerate(ls_chunk):
+            ls_section_part.append((section_label, chunk, part_index, len(ls_chunk)))
+    dt_part_structure = {}
+    for i, section_structure_json in multiprocess_as_completed(
+        func=_extract_section_part_structure,
+        paras=ls_section_part,
+        paper_structure=overall_structure,
+        n_processes=get_llm_parallelism(len(ls_section_part)),
+        cost_func=lambda section_part: count_tokens(section_part[1])
+    ):
+        section_label, _, part_index, part_num = ls_section_part[i]
+        dt_part_structure.setdefault(section_label, {})[part_index] = section_structure_json
+        if len(dt_part_structure[section_label]) == part_num:
+            ls_structure = [dt_part_structure[section_label][part_index] for part_index in range(part_num)]
+            yield section_label, merge_section_structures(ls_structure)
+
+
+def extract_paper_structure(paper_text, progress_callback=None, overall_structure=None, dt_section_structure=None):
+    """
+    Extracts the overall structure and the structure of every section.
+    For a revised draft, pass the previous overall_structure (when the outline has not changed) and the previous
+    dt_section_structure of the unchanged sections; only the remaining sections are extracted again.
+    progress_callback(section_label, section_structure, done_num, total_num) is called as each section finishes.
+    """
+    if overall_structure is None:
+        print("Extracting overall structure")
+        overall_structure = extract_overall_structure(paper_text)
+        print(overall_structure)
     dt_section = extract_sections(paper_text)
-    ls_section_pairs = []
-    for section_label in dt_section:
-        ls_section_pairs.append((section_label, dt_section[section_label]))
-    print("Extracting section structures")
-    ls_section_structure_json = multiprocess(
-        func=extract_section_structure,
-        paras=ls_section_pairs,
-        paper_structure=overall_structure_json,
-        n_processes=min(len(ls_section_pairs), get_cpu_count())
-    )
-    dt_section_structure = dict(zip(list(dt_section.keys()), ls_section_structure_json))
+    dt_reused = {
+        section_label: section_structure for section_label, section_structure in (dt_section_structure or {}).items()
+        if section_label in dt_section
+    }
+    dt_section_structure = {}
+    for section_label, section_structure_json in dt_reused.items():
+        dt_section_structure[section_label] = section_structure_json
+        if progress_callback is not None:
+            progress_callback(section_label, section_structure_json, len(dt_section_structure), len(dt_section))
+    print(f"Extracting section structures ({len(dt_section) - len(dt_reused)} of {len(dt_section)} sections)")
+    dt_changed = {section_label: section_content for section_label, section_content in dt_section.items() if section_label not in dt_reused}
+    for section_label, section_structure_json in iter_section_structures(dt_changed, overall_structure):
+        dt_section_structure[section_label] = section_structure_json
+        if progress_callback is not None:
+            progress_callback(section_label, section_structure_json, len(dt_section_structure), len(dt_section))
     dt_paper = {
-        'overall_stu': overall_structure_json,
-        'section_stu': dt_section_structure,
+        'overall_stu': overall_structure,
+        'section_stu': {section_label: dt_section_structure[section_label] for section_label in dt_section},
         'section_con': dt_section
     }
     return dt_paper
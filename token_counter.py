@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import md5
+
+import tiktoken
+
+# 各模型的上下文窗口大小（prompt + completion）
+model_context_window = {
+    "gpt-4": 8192,
+    "gpt-4-1106-preview": 128000,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-1106": 16385,
+    "text-embedding-ada-002": 8191,
+}
+default_context_window = 8192
+
+# 每条消息的格式开销，以及回复起始的固定开销
+tokens_per_message = 3
+tokens_per_reply = 3
+
+_count_cache = OrderedDict()
+_count_cache_size = 100000
+_count_cache_lock = threading.Lock()
+
+# 批量统计共用的线程池，首次需要时创建
+_batch_executor = None
+_batch_executor_size = 8
+_batch_executor_lock = threading.Lock()
+
+
+class PromptTooLongError(ValueError):
+    """
+    prompt超过模型上下文窗口时抛出，发送请求前即可发现
+    """
+
+    def __init__(self, prompt_tokens, max_tokens, context_window, llm_model):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.context_window = context_window
+        self.llm_model = llm_model
+        super().__init__(
+            f"prompt长度{prompt_tokens} + 回复上限{max_tokens or 0}超过了{llm_model}的上下文窗口{context_window}"
+        )
+
+
+@lru_cache(maxsize=None)
+def get_encoder(llm_model="gpt-4"):
+    """
+    加载模型对应的编码器，每个模型只加载一次
+    """
+    try:
+        return tiktoken.encoding_for_model(llm_model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, llm_model="gpt-4"):
+    """
+    统计文本中的token数量，结果按(编码器, 文本hash)缓存
+    """
+    encoder = get_encoder(llm_model)
+    key = (encoder.name, md5(text.encode("utf-8")).hexdigest())
+    with _count_cache_lock:
+        num_tokens = _count_cache.get(key)
+        if num_tokens is not None:
+            _count_cache.move_to_end(key)
+            return num_tokens
+
+    num_tokens = len(encoder.encode(text, disallowed_special=()))
+    with _count_cache_lock:
+        _count_cache[key] = num_tokens
+        if len(_count_cache) > _count_cache_size:
+            _count_cache.popitem(last=False)
+    return num_tokens
+
+
+def _get_batch_executor():
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=_batch_executor_size, thread_name_prefix="token_counter")
+        return _batch_executor
+
+
+def count_tokens_batch(texts, llm_model="gpt-4", n_threads=8):
+    """
+    批量统计token数量，返回顺序与texts一致
+    tiktoken编码时会释放GIL，因此用线程池即可并行；少于2 * n_threads条时直接在当前线程统计，
+    否则使用模块级共用的线程池，不再每次调用都新建线程
+    """
+    if len(texts) < 2 * n_threads:
+        return [count_tokens(text, llm_model) for text in texts]
+    return list(_get_batch_executor().map(lambda text: count_tokens(text, llm_model), texts))
+
+
+def count_messages_tokens(messages, llm_model="gpt-4"):
+    """
+    统计一组对话消息作为prompt时的token数量
+    """
+    counts = count_tokens_batch([item["content"] for item in messages], llm_model)
+    return sum(counts) + tokens_per_message * len(messages) + tokens_per_reply
+
+
+def check_prompt_budget(messages, llm_model="gpt-4", max_tokens=None):
+    """
+    发送请求前检查prompt是否超出模型的上下文窗口，超出时抛出PromptTooLongError，否则返回prompt的token数
+    """
+    prompt_tokens = count_messages_tokens(messages, llm_model)
+    context_window = model_context_window.get(llm_model, default_context_window)
+    if prompt_tokens + (max_tokens or 0) > context_window:
+        raise PromptTooLongError(prompt_tokens, max_tokens, context_window, llm_model)
+    return prompt_tokens
+
+
+def split_text_by_budget(text, max_tokens, llm_model="gpt-4"):
+    """
+    按段落将文本切分成若干块，每块不超过max_tokens个token
+    单个段落过长时按行切分，单行仍过长时按token硬切分
+    """
+    encoder = get_encoder(llm_model)
+    pieces = []
+    for paragraph in text.split("\n\n"):
+        if count_tokens(paragraph, llm_model) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for line in paragraph.split("\n"):
+            if count_tokens(line, llm_model) <= max_tokens:
+                pieces.append(line)
+                continue
+            tokens = encoder.encode(line, disallowed_special=())
+            for i in range(0, len(tokens), max_tokens):
+                pieces.append(encoder.decode(tokens[i : i + max_tokens]))
+
+    chunks = []
+    current_chunk = []
+    current_tokens = 0
+    for piece in pieces:
+        # 段落之间的空行按2个token估计
+        piece_tokens = count_tokens(piece, llm_model) + 2
+        if current_chunk and current_tokens + piece_tokens > max_tokens:
+            chunks.append("\n\n".join(current_chunk))
+            current_chunk = []
+            current_tokens = 0
+        current_chunk.append(piece)
+        current_tokens += piece_tokens
+    if current_chunk:
+        chunks.append("\n\n".join(current_chunk))
+    return chunks
+
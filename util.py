@@ -1,6 +1,10 @@
+import contextvars
 import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from io import StringIO
-from multiprocessing import Process, cpu_count
+from multiprocessing import cpu_count, get_context
 import joblib
 
 
@@ -28,71 +32,131 @@ def load(fn):
 
 # ----------- multiprocessing ---------------------- #
 
-def single_process(func, index, para_l, prefix, args):
-    results = []
-    if para_l is not None:
-        for p in para_l:
-            #print 'single_process', index, p,
-            res = func(p, **args)
-            #print re
-            results.append(res)
-    else:
-        results = func(**args)
-    fn = 'tmp/%s_%d.p' % (prefix, index)
-    dump(fn, results)
-
-
-def multiprocess(func, paras=[], name=None, n_processes=1, **args):
-
-    result = []
-    if n_processes == 1:
-        if paras == []:
-            return func(**args)
-        else:
-            for p in paras:
-                result.append(func(p, **args))
-        return result
-    if not os.path.exists('tmp'):
-        os.mkdir('tmp')
-    l = len(paras)
-    size = l // n_processes
-    j = 0
-    jobs = []
-    prefix = func.__name__ + '_%s' % os.getpid()
-    for i in range(n_processes):
-        # print i, self.feature.para_range[j:end_]
-        if i < l % n_processes:
-            gap = size + 1
-        else:
-            gap = size
-        if l == 0:
-            tmp_paras = None
-        else:
-            tmp_paras = paras[j:j + gap]
-        if name == None:
-            namep = 'process%d' % (i+1)
-        else:
-            namep = name[i]
-        p = Process(target=single_process, name=namep, args=(func, i, tmp_paras, prefix, args))
-        jobs.append(p)
-        p.start()
-        j += gap
-        if (j >= l) and (l != 0):
-            break
-    n_processes = len(jobs)
-    for i in range(n_processes):
-        jobs[i].join()
-    return collect_data(prefix, n_processes)
-
-
-def collect_data(prefix, num):
-    data = []
-    for i in range(num):
-        fn = 'tmp/%s_%d.p' % (prefix, i)
-        d = load(fn)
-        data.extend(d)
-        os.remove(fn)
-    return data
+# 常驻的线程池（大模型请求等I/O密集任务）和可选的进程池（CPU密集任务），按进程创建，fork出的子进程会重新创建
+max_thread_workers = 64
+_executor_lock = threading.Lock()
+_thread_executor = None
+_process_executor = None
+_executor_pid = None
+# 标记当前线程是否为线程池中的worker，worker内嵌套调用multiprocess时直接顺序执行，避免占满线程池后互相等待
+_worker_state = threading.local()
+
+
+def _get_executor(use_process=False):
+    global _thread_executor, _process_executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            _thread_executor = None
+            _process_executor = None
+            _executor_pid = os.getpid()
+        if use_process:
+            if _process_executor is None:
+                _process_executor = ProcessPoolExecutor(max_workers=cpu_count(), mp_context=get_context("fork"))
+            return _process_executor
+        if _thread_executor is None:
+            _thread_executor = ThreadPoolExecutor(max_workers=max_thread_workers, thread_name_prefix="multiprocess")
+        return _thread_executor
+
+
+def _run_in_worker(func, p, args):
+    _worker_state.active = True
+    try:
+        return func(p, **args)
+    finally:
+        _worker_state.active = False
+
+
+def _iter_completed(func, paras, n_processes, use_process, cost_func, args):
+    """
+    按完成顺序yield (下标, 结果, 异常)
+    """
+    if n_processes == 1 or len(paras) == 1 or getattr(_worker_state, "active", False):
+        for i, p in enumerate(paras):
+            try:
+                yield i, func(p, **args), None
+            except Exception as error:
+                yield i, None, error
+        return
+
+    ls_order = list(range(len(paras)))
+    if cost_func is not None:
+        ls_order.sort(key=lambda i: cost_func(paras[i]), reverse=True)
+
+    if use_process:
+        executor = _get_executor(use_process=True)
+        dt_index = {executor.submit(func, paras[i], **args): i for i in ls_order}
+        for future in as_completed(dt_index):
+            yield dt_index[future], (future.result() if future.exception() is None else None), future.exception()
+        return
+
+    # 启动n_processes个worker，每个worker依次领取下一个任务，完成的结果放入队列
+    completed = queue.Queue()
+    ls_index = iter(ls_order)
+    index_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def worker(context):
+        while not stopped.is_set():
+            with index_lock:
+                i = next(ls_index, None)
+            if i is None:
+                return
+            try:
+                completed.put((i, context.run(_run_in_worker, func, paras[i], args), None))
+            except Exception as error:
+                completed.put((i, None, error))
+            except BaseException as error:
+                # KeyboardInterrupt、SystemExit等：交给调用方抛出，其余worker不再领取新任务
+                stopped.set()
+                completed.put((i, None, error))
+                return
+
+    executor = _get_executor()
+    for _ in range(min(n_processes, len(paras))):
+        executor.submit(worker, contextvars.copy_context())
+    try:
+        for _ in range(len(paras)):
+            i, result, error = completed.get()
+            if error is not None and not isinstance(error, Exception):
+                raise error
+            yield i, result, error
+    finally:
+        # 调用方提前结束（抛出异常或break）时，worker不再领取新任务
+        stopped.set()
+
+
+def multiprocess_as_completed(func, paras, n_processes=1, use_process=False, cost_func=None, **args):
+    """
+    与multiprocess相同的并行方式，但按完成顺序逐个yield (下标, 结果)，某个任务抛出异常时在yield到它时抛出
+    """
+    for i, result, error in _iter_completed(func, paras, n_processes, use_process, cost_func, args):
+        if error is not None:
+            raise error
+        yield i, result
+
+
+def multiprocess(func, paras=[], name=None, n_processes=1, use_process=False, cost_func=None, progress_callback=None, **args):
+    """
+    对paras中的每个元素并行执行func(p, **args)，结果按paras的顺序返回
+    默认在常驻线程池中执行（同时最多n_processes个），空闲的worker每次领取一个任务，contextvars（用量记录、重试预算、取消令牌）随任务传递；
+    给定cost_func时按cost_func(p)（如token数）从大到小派发任务，避免耗时最长的任务最后才开始；
+    use_process=True时在常驻进程池中执行CPU密集任务，此时func和参数需要可以pickle
+    每个任务完成时调用progress_callback(完成数量, 总数量)
+    某个任务抛出异常时，等所有任务结束后按顺序抛出第一个异常；name仅为兼容旧接口保留
+    """
+    if paras == []:
+        return func(**args)
+    results = [None] * len(paras)
+    errors = [None] * len(paras)
+    for num_done, (i, result, error) in enumerate(_iter_completed(func, paras, n_processes, use_process, cost_func, args), 1):
+        results[i] = result
+        errors[i] = error
+        if progress_callback is not None:
+            progress_callback(num_done, len(paras))
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
 
 
 def process_uploaded_paper_data(uploaded_file):
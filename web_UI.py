@@ -1,14 +1,19 @@
 from io import StringIO
 
+import contextvars
+import threading
 import numpy as np
 import streamlit as st
 import time
 from rewrite import *
-from content_analysis import section_analysis_async, modify_scheme_design
+from content_analysis import section_analysis_async, modify_scheme_design, replace_at_sentences
 from paper_scoring import paper_scoring
 from util import *
 from paper_class import *
-from structure_extraction import extract_paper_structure, extract_title
+from structure_extraction import extract_paper_structure, extract_sections, extract_title
+from latex_sections import get_section_index
+from latex_project import load_latex_project
+from llm_api import CancelToken, RetryBudgetExhausted, cancel_scope, retry_scope, usage_context
 
 # 设置页面配置
 st.set_page_config(
@@ -17,6 +22,10 @@ st.set_page_config(
     layout="wide",
 )
 
+# 一次论文处理（或一次润色、重新打分）的重试预算：所有大模型调用共享的重试次数上限和总时长（秒）
+pipeline_max_retries = 30
+pipeline_timeout = 900
+
 # 初始化状态变量
 if 'file_uploaded' not in st.session_state:
     st.session_state.file_uploaded = False
@@ -30,48 +39,139 @@ def set_page_state_to_uploaded():
     st.session_state.file_uploaded = True
 
 
+def process_paper(paper, uploaded_file, progress, cancel_token, previous_paper=None):
+    """
+    在后台线程中处理论文，进度写入progress['value']，分析完成的section依次加入progress['sections']，异常写入progress['error']
+    previous_paper为同名论文的缓存：内容完全相同时直接沿用；否则只重新抽取和分析修改过或新增的section，大纲不变时沿用整体结构
+    取消后跳过剩余步骤，已完成的结果保留在paper中
+    """
+    def on_section_structure(section_label, section_structure, done_num, total_num):
+        progress['value'] = 10 + int(40 * done_num / total_num)
+
+    def on_section_analysis(section_label, analysis_result, done_num, total_num):
+        paper.dt_analysis_result[section_label] = analysis_result
+        progress['sections'].append(section_label)
+        progress['value'] = 50 + int(40 * done_num / total_num)
+
+    try:
+        with usage_context(paper_id=paper.file_name), retry_scope(max_retries=pipeline_max_retries, timeout=pipeline_timeout), \
+                cancel_scope(cancel_token):
+            # 将latex文件转成字符串，多文件项目（.zip）展开\input、\include、\subfile后合成一份文档
+            # 同一会话中之前上传的项目不能用于这次上传的写回
+            paper.latex_project = None
+            if uploaded_file.name.lower().endswith('.zip'):
+                paper.latex_project = load_latex_project(uploaded_file.getvalue())
+                paper_content = paper.latex_project.flatten()
+            else:
+                paper_content = process_uploaded_paper_data(uploaded_file)
+            if previous_paper is not None and previous_paper.paper_content == paper_content:
+                latex_project = paper.latex_project
+                paper.load_cache(previous_paper.get_cache())
+                paper.latex_project = latex_project
+                progress['cached'] = True
+                return
+            paper.paper_content = paper_content
+            progress['value'] = 5
+            # 抽取论文题目
+            paper_title = extract_title(paper_content)
+            if paper_title is None:
+                paper_title = "Unknown Title"
+            paper.title = paper_title
+            # 抽取论文结构，修改过的论文只重新抽取变化的部分
+            ls_unchanged = []
+            overall_structure = None
+            if previous_paper is not None:
+                ls_unchanged = previous_paper.unchanged_sections(extract_sections(paper_content))
+                if not previous_paper.outline_changed(paper_content):
+                    overall_structure = previous_paper.overall_structure
+            dt_paper = extract_paper_structure(
+                paper_content, progress_callback=on_section_structure, overall_structure=overall_structure,
+                dt_section_structure={section_label: previous_paper.dt_section_structure[section_label] for section_label in ls_unchanged}
+            )
+            progress['value'] = 50
+            paper.overall_structure = dt_paper['overall_stu']
+            paper.dt_section_structure = dt_paper['section_stu']
+            paper.dt_section_content = dt_paper['section_con']
+            paper.update_section_hash()
+            # 初始化润色结果
+            paper.initial_polishing_result(previous_paper)
+            if cancel_token.cancelled:
+                return
+            # 全文内容检查
+            paper.dt_analysis_result = {}
+            dt_previous_analysis = {
+                section_label: (previous_paper.dt_analysis_result or {}).get(section_label) for section_label in ls_unchanged
+            }
+            ls_analysis_result = section_analysis_async(paper.dt_section_content, paper.dt_section_structure, paper.overall_structure,
+                                                        progress_callback=on_section_analysis, dt_analysis_result=dt_previous_analysis)
+            dt_analysis_result = dict(zip(list(paper.dt_section_content.keys()), ls_analysis_result))
+            paper.dt_analysis_result = dt_analysis_result
+            progress['value'] = 90
+            if cancel_token.cancelled:
+                return
+            # 全文打分
+            dt_score = paper_scoring(paper.paper_content)
+            if dt_score is None:
+                return
+            paper.dt_score = dt_score
+            paper.paper_score = np.mean(list(paper.dt_score.values()))
+            progress['value'] = 95
+    except Exception as error:
+        progress['error'] = error
+    return
+
+
+def slot_stop_processing():
+    # 点击按钮触发的页面重新运行会中断正在进行的处理（见show_file_progress_and_result），已完成的section结果保留
+    st.session_state['processing_stopped'] = True
+    if st.session_state['paper'].dt_section_content is not None:
+        set_page_state_to_uploaded()
+
+
 def show_file_progress_and_result(placeholder, uploaded_file):
-    with placeholder:
+    with placeholder.container():
         with st.spinner('文件处理中，请稍候...'):
             progress_bar = st.progress(0)
-            paper = st.session_state['paper']
+            # 每次上传使用新的Paper，提前停止时页面只展示这次上传已完成的结果，不会混入上一篇论文的section和分析结果
+            paper = Paper()
+            st.session_state['paper'] = paper
             # 检查是否存在论文缓存
             file_name = uploaded_file.name
             paper.file_name = file_name
             paper_cache = load_from_cache(file_name)
-            if paper_cache is None:
-                # 将latex文件转成字符串
-                paper_content = process_uploaded_paper_data(uploaded_file)
-                paper.paper_content = paper_content
-                progress_bar.progress(5)
-                # 抽取论文题目
-                paper_title = extract_title(paper_content)
-                if paper_title is None:
-                    paper_title = "Unknown Title"
-                paper.title = paper_title
-                # 抽取论文结构
-                dt_paper = extract_paper_structure(paper_content)
-                progress_bar.progress(50)
-                paper.overall_structure = dt_paper['overall_stu']
-                paper.dt_section_structure = dt_paper['section_stu']
-                paper.dt_section_content = dt_paper['section_con']
-                # 全文内容检查
-                ls_analysis_result = section_analysis_async(paper.dt_section_content, paper.dt_section_structure, paper.overall_structure)
-                dt_analysis_result = dict(zip(list(paper.dt_section_content.keys()), ls_analysis_result))
-                paper.dt_analysis_result = dt_analysis_result
-                progress_bar.progress(90)
-                # 全文打分
-                dt_score = paper_scoring(paper.paper_content)
-                paper.dt_score = dt_score
-                paper.paper_score = np.mean(list(paper.dt_score.values()))
-                progress_bar.progress(95)
-                # 初始化润色结果
-                paper.initial_polishing_result()
-                # 存储论文
+            st.button('Stop processing', on_click=slot_stop_processing)
+            progress = {'value': 0, 'error': None, 'sections': [], 'cached': False}
+            # 同名论文的缓存用于增量处理：内容未变时直接沿用，否则只重新处理修改过的section
+            # 分析完成的section在处理过程中就逐个展示
+            sections_container = st.container()
+            rendered_num = 0
+            cancel_token = CancelToken()
+            worker = threading.Thread(
+                target=contextvars.copy_context().run, args=(process_paper, paper, uploaded_file, progress, cancel_token, paper_cache),
+                daemon=True
+            )
+            worker.start()
+            try:
+                # 轮询时调用streamlit接口，页面重新运行（如点击Stop processing）时会在这里中断
+                while worker.is_alive():
+                    progress_bar.progress(progress['value'])
+                    while rendered_num < len(progress['sections']):
+                        section_label = progress['sections'][rendered_num]
+                        with sections_container.expander(section_label):
+                            st.markdown(paper.dt_analysis_result.get(section_label) or '', unsafe_allow_html=True)
+                        rendered_num += 1
+                    time.sleep(0.2)
+            finally:
+                if worker.is_alive():
+                    cancel_token.cancel()
+                    worker.join()
+            if progress['error'] is not None:
+                progress_bar.empty()
+                st.error(f'Paper processing failed: {progress["error"]}')
+                return
+            # 存储论文（与缓存完全相同时不需要重新存储）
+            if not progress['cached']:
                 save_cache(paper)
-            else:
-                paper = paper_cache
-                progress_bar.progress(100)
             st.session_state['paper'] = paper
             progress_bar.empty()
             set_page_state_to_uploaded()
@@ -84,9 +184,17 @@ def show_file_progress_and_result(placeholder, uploaded_file):
 def upload_page(placeholder):
     with placeholder:
         st.title('Upload you .tex paper')
-        uploaded_file = st.file_uploader("", type=['tex'])
+        st.caption('A multi-file LaTeX project can be uploaded as a .zip archive.')
+        uploaded_file = st.file_uploader("", type=['tex', 'zip'], on_change=slot_new_upload)
         if uploaded_file is not None:
-            show_file_progress_and_result(placeholder, uploaded_file)
+            if st.session_state.get('processing_stopped', False):
+                st.info('Processing stopped. Upload the paper again to restart.')
+            else:
+                show_file_progress_and_result(placeholder, uploaded_file)
+
+
+def slot_new_upload():
+    st.session_state['processing_stopped'] = False
 
 
 # 使用一个函数来切换按钮状态并在需要时显示表单
@@ -99,8 +207,16 @@ def toggle_custom_input(box_title, button_type):
 
 def slot_rescoring():
     paper = st.session_state['paper']
-    polishing_paper = get_polishing_paper(paper.paper_content, paper.dt_polishing_result)
-    dt_score = paper_scoring(polishing_paper)
+    try:
+        with usage_context(paper_id=paper.file_name), retry_scope(max_retries=pipeline_max_retries, timeout=pipeline_timeout):
+            polishing_paper = get_polishing_paper(paper.paper_content, paper.dt_polishing_result)
+            dt_score = paper_scoring(polishing_paper)
+    except RetryBudgetExhausted as error:
+        st.error(f'Rescoring failed: {error}')
+        return
+    if dt_score is None:
+        st.error('Rescoring failed: no complete score was returned.')
+        return
 
     st.session_state['paper'].dt_score = dt_score
     st.session_state['paper'].paper_score = np.mean(list(paper.dt_score.values()))
@@ -113,38 +229,75 @@ def slot_cache_paper():
 
 
 def slot_rewrite_language_issue(section_label):
-    paper = st.session_state['paper']
-    polishing_section = rewrite_language_issue(section_label, paper.dt_section_content[section_label], paper.dt_analysis_result[section_label])
-    st.session_state['paper'].dt_polishing_result[section_label] = polishing_section
+    # 润色在页面重新渲染到该section时以流式方式执行，见run_streaming_job
+    st.session_state['streaming_job'] = (section_label, 'language', None)
 
 
 def slot_rewrite_logic_issue(section_label):
-    paper = st.session_state['paper']
-    polishing_section = rewrite_logic_issue(section_label, paper.dt_section_content[section_label], paper.dt_analysis_result[section_label],
-                                            paper.dt_section_structure[section_label])
-    st.session_state['paper'].dt_polishing_result[section_label] = polishing_section
+    st.session_state['streaming_job'] = (section_label, 'logic', None)
 
 
 def slot_rewrite_issue(section_label):
-    paper = st.session_state['paper']
-    polishing_section = rewrite_language_issue(section_label, paper.dt_section_content[section_label], paper.dt_analysis_result[section_label])
-    polishing_section = rewrite_logic_issue(section_label, polishing_section, paper.dt_analysis_result[section_label],
-                                            paper.dt_section_structure[section_label])
-    st.session_state['paper'].dt_polishing_result[section_label] = polishing_section
+    st.session_state['streaming_job'] = (section_label, 'section', None)
 
 
 def slot_rewrite_with_review(section_label, review, box_title, rewite_type):
-    paper = st.session_state['paper']
-    if rewite_type == 'design_input':
-        review = modify_scheme_design(review, section_label, paper.dt_section_content[section_label], paper.dt_section_structure[section_label],
-                                      paper.overall_structure)
-        print(review)
-    polishing_section = rewrite_logic_issue_reflect(section_label, paper.dt_section_content[section_label], review,
-                                                    paper.dt_section_structure[section_label])
-    st.session_state['paper'].dt_polishing_result[section_label] = polishing_section
+    st.session_state['streaming_job'] = (section_label, rewite_type, review)
     toggle_custom_input(box_title, rewite_type)
 
 
+def streaming_job_events(section_label, job_type, review):
+    """
+    生成润色任务的(channel, 当前完整文本)事件流，channel为"analysis"（润色方案、反思）或"polish"（润色结果）
+    """
+    paper = st.session_state['paper']
+    section_content = paper.dt_section_content[section_label]
+    section_review = (paper.dt_analysis_result or {}).get(section_label) or ''
+    section_structure = paper.dt_section_structure[section_label]
+    if job_type == 'language':
+        yield from stream_channel('polish', rewrite_language_issue(section_label, section_content, section_review, stream=True))
+    elif job_type == 'logic':
+        yield from stream_channel('polish', rewrite_logic_issue(section_label, section_content, section_review, section_structure, stream=True))
+    elif job_type == 'section':
+        polishing_section = section_content
+        for channel, polishing_section in stream_channel('polish', rewrite_language_issue(section_label, section_content, section_review, stream=True)):
+            yield channel, polishing_section
+        yield from stream_channel('polish', rewrite_logic_issue(section_label, polishing_section, section_review, section_structure, stream=True))
+    else:
+        if job_type == 'design_input':
+            scheme_stream = modify_scheme_design(review, section_label, section_content, section_structure, paper.overall_structure, stream=True)
+            for channel, review in stream_channel('analysis', scheme_stream):
+                yield channel, review
+            # 与非流式的modify_scheme_design相同，润色方案经过replace_at_sentences后再用于改写
+            review = replace_at_sentences(review)
+        yield from rewrite_logic_issue_reflect(section_label, section_content, review, section_structure, stream=True)
+
+
+def run_streaming_job(section_label, analysis_placeholder, polish_placeholder):
+    """
+    若有待执行的润色任务属于该section，则执行并将增量结果实时渲染到右侧栏
+    """
+    job = st.session_state.get('streaming_job')
+    if job is None or job[0] != section_label:
+        return
+    st.session_state['streaming_job'] = None
+    paper = st.session_state['paper']
+    polishing_section = None
+    try:
+        with usage_context(paper_id=paper.file_name), retry_scope(max_retries=pipeline_max_retries, timeout=pipeline_timeout):
+            for channel, text in streaming_job_events(*job):
+                if channel == 'analysis':
+                    analysis_placeholder.markdown(replace_at_sentences(text), unsafe_allow_html=True)
+                else:
+                    polishing_section = text
+                    polish_placeholder.markdown(text, unsafe_allow_html=True)
+    except Exception as error:
+        # 与论文处理相同：重试预算用完、prompt过长、被取消或流式输出中途出错都在页面上提示，不中断页面
+        st.error(f'Polishing failed: {error}')
+    if polishing_section is not None:
+        st.session_state['paper'].dt_polishing_result[section_label] = polishing_section
+
+
 def review_system_page(placeholder):
     with placeholder.container():
         paper = st.session_state['paper']
@@ -154,17 +307,21 @@ def review_system_page(placeholder):
         st.subheader("Total Score")
         # 获取最新的总分数并展示
         total_score = paper.paper_score
-        st.write(f"Total score: {total_score} / 10")
-
-        st.subheader("Each Subitem Score")
-
-        col1, col2 = st.columns(2)
-        with col1:
-            st.write(f"Consistency: {paper.dt_score['Consistency']} / 10")
-            st.write(f"Coherence: {paper.dt_score['Coherence']} / 10")
-        with col2:
-            st.write(f"Conciseness: {paper.dt_score['Conciseness']} / 10")
-            st.write(f"Substantiveness: {paper.dt_score['Substantiveness']} / 10")
+        if paper.dt_score is None:
+            # 处理被中途停止时还没有打分，可以点击Rescoring
+            st.write("Total score: not scored yet")
+        else:
+            st.write(f"Total score: {total_score} / 10")
+
+            st.subheader("Each Subitem Score")
+
+            col1, col2 = st.columns(2)
+            with col1:
+                st.write(f"Consistency: {paper.dt_score['Consistency']} / 10")
+                st.write(f"Coherence: {paper.dt_score['Coherence']} / 10")
+            with col2:
+                st.write(f"Conciseness: {paper.dt_score['Conciseness']} / 10")
+                st.write(f"Substantiveness: {paper.dt_score['Substantiveness']} / 10")
 
         # "重新评分" 按钮
         col1, col2 = st.columns(2)
@@ -172,9 +329,14 @@ def review_system_page(placeholder):
             st.button("Rescoring", on_click=slot_rescoring)
         with col2:
             st.button("Cache polishing results", on_click=slot_cache_paper)
+        export_name, export_data, ls_skipped = export_polishing_paper(paper)
+        st.download_button("Download polished paper", data=export_data, file_name=export_name)
+        if ls_skipped:
+            st.warning(f'These sections span several source files and were not written back: {", ".join(ls_skipped)}')
 
         # 循环创建框和按钮，假设创建两个框，可以按照需要进行修改
         ls_section_label = list(paper.dt_section_content.keys())
+        section_index = get_section_index(paper.paper_content)
         for i in range(len(paper.dt_section_content)):
             section_label = ls_section_label[i]
             box_title = f'Box {i}'
@@ -182,10 +344,19 @@ def review_system_page(placeholder):
                 left_col, right_col = st.columns([3, 2])  # 分配3:2的比例给左右两列
 
                 with left_col:
-                    st.subheader(section_label)
+                    # 子章节的标题前显示其所属的上级章节
+                    section_node = section_index.get(section_label)
+                    ls_title = [section_label]
+                    while section_node is not None and section_node.parent is not None:
+                        section_node = section_node.parent
+                        ls_title.insert(0, section_node.title)
+                    st.subheader(' › '.join(ls_title))
                     # 假设的Markdown内容，可以根据实际需求调整
-                    content = paper.dt_analysis_result[section_label]
-                    st.markdown(content, unsafe_allow_html=True)
+                    content = (paper.dt_analysis_result or {}).get(section_label)
+                    if content is None:
+                        st.info('The analysis of this section did not finish.')
+                    else:
+                        st.markdown(content, unsafe_allow_html=True)
 
                     # 按钮横向排列
                     btn_cols = st.columns(5)  # 5个按钮分布于5列，自适应宽度
@@ -218,7 +389,10 @@ def review_system_page(placeholder):
 
                 with right_col:
                     st.subheader(f'{section_label} - Polishing results')
-                    st.markdown(paper.dt_polishing_result[section_label], unsafe_allow_html=True)
+                    analysis_placeholder = st.empty()
+                    polish_placeholder = st.empty()
+                    polish_placeholder.markdown(paper.dt_polishing_result[section_label], unsafe_allow_html=True)
+                    run_streaming_job(section_label, analysis_placeholder, polish_placeholder)
 
 
 if 'file_uploaded' not in st.session_state: